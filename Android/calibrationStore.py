@@ -0,0 +1,340 @@
+import glob
+import io
+import os
+import sqlite3
+import struct
+import tempfile
+import threading
+import time
+import zipfile
+import numpy as np
+
+databaseName = 'calibrations.db'  # Every calibration ever saved, next to the calibration scripts
+
+# The small arrays every tracker needs, read as soon as a calibration is loaded. Everything else in the file (rvecs,
+# tvecs, perViewErrors, perCornerResiduals, ...) is only memory-mapped when it is asked for.
+intrinsicNames = ('cameraMatrix', 'distCoeffs')
+
+def memoryMapNpzMember(path, name):
+    # np.load ignores mmap_mode for .npz files, but np.savez stores its arrays uncompressed, so the .npy data sits
+    # unchanged inside the zip and can be mapped straight from the file. Returns None when it can't be, e.g. for
+    # np.savez_compressed files or object arrays, and the caller reads the member normally instead.
+    with zipfile.ZipFile(path) as archive:
+        info = archive.getinfo(f'{name}.npy')
+    if info.compress_type != zipfile.ZIP_STORED:
+        return None
+
+    with open(path, 'rb') as f:
+        # The local file header is 30 bytes followed by the file name and an extra field of their own lengths
+        f.seek(info.header_offset)
+        header = f.read(30)
+        nameLength, extraLength = struct.unpack('<HH', header[26:30])
+        f.seek(info.header_offset + 30 + nameLength + extraLength)
+        version = np.lib.format.read_magic(f)
+        if version == (1, 0):
+            shape, fortranOrder, dtype = np.lib.format.read_array_header_1_0(f)
+        else:
+            shape, fortranOrder, dtype = np.lib.format.read_array_header_2_0(f)
+        offset = f.tell()
+
+    if dtype.hasobject:
+        return None
+    if 0 in shape:
+        return np.zeros(shape, dtype)
+    return np.memmap(path, dtype=dtype, mode='r', offset=offset, shape=shape, order='F' if fortranOrder else 'C')
+
+class Calibration:
+    # One loaded calibration file. cameraMatrix and distCoeffs are plain arrays, calibration['rvecs'] and the other
+    # per-view arrays are read-only memory maps created on first use, so they cost nothing until someone looks at them.
+    def __init__(self, path, modified):
+        self.path = path
+        self.modified = modified  # (mtime in ns, size) of the file this was loaded from
+        self.lock = threading.Lock()
+        self.arrays = {}
+        with np.load(path) as data:
+            self.names = list(data.files)
+            for name in intrinsicNames:
+                self.arrays[name] = data[name]
+        self.cameraMatrix = self.arrays['cameraMatrix']
+        self.distCoeffs = self.arrays['distCoeffs']
+
+    def __getitem__(self, name):
+        with self.lock:
+            array = self.arrays.get(name)
+            if array is None:
+                if name not in self.names:
+                    raise KeyError(f'{name} is not in calibration {self.path}')
+                array = memoryMapNpzMember(self.path, name)
+                if array is None:
+                    with np.load(self.path) as data:
+                        array = data[name]
+                self.arrays[name] = array
+            return array
+
+    def __contains__(self, name):
+        return name in self.names
+
+class CalibrationStore:
+    # Caches one Calibration per camera ID, shared by every thread in the process. Each get() stats the file and
+    # reloads it if it was rewritten since, so recalibrating a camera is picked up without restarting the trackers.
+    def __init__(self):
+        self.paths = {}  # Camera ID -> calibration file
+        self.calibrations = {}  # Camera ID -> Calibration
+        self.lock = threading.Lock()
+
+    def register(self, cameraId, path):
+        with self.lock:
+            path = os.path.abspath(path)
+            if self.paths.get(cameraId) != path:
+                self.paths[cameraId] = path
+                self.calibrations.pop(cameraId, None)
+
+    def get(self, cameraId):
+        with self.lock:
+            path = self.paths.get(cameraId)
+        if path is None:
+            raise KeyError(f'No calibration registered for camera {cameraId!r}')
+
+        stat = os.stat(path)
+        modified = (stat.st_mtime_ns, stat.st_size)
+        with self.lock:
+            calibration = self.calibrations.get(cameraId)
+            if calibration is None or calibration.modified != modified or calibration.path != path:
+                calibration = Calibration(path, modified)
+                self.calibrations[cameraId] = calibration
+            return calibration
+
+calibrationStore = CalibrationStore()
+
+def getCalibration(path='cameraCalibration.npz', cameraId=None):
+    # Loads a calibration file through the shared calibrationStore, cameraId defaults to the file's absolute path so
+    # every tracker using the same file shares one copy
+    if cameraId is None:
+        cameraId = os.path.abspath(path)
+    calibrationStore.register(cameraId, path)
+    return calibrationStore.get(cameraId)
+
+def arrayToBlob(array):
+    buffer = io.BytesIO()
+    np.save(buffer, np.asarray(array), allow_pickle=False)
+    return buffer.getvalue()
+
+def blobToArray(blob):
+    return np.load(io.BytesIO(blob), allow_pickle=False)
+
+class StoredCalibration:
+    # One row of a CalibrationDatabase, with the same cameraMatrix/distCoeffs/calibration['rvecs'] interface as
+    # Calibration. The per-view arrays stay in the database until they are first asked for.
+    def __init__(self, database, row):
+        self.database = database
+        self.id, self.cameraId, width, height, self.createdAt, self.rms, cameraMatrix, distCoeffs, names = row
+        self.imageSize = (width, height)
+        self.cameraMatrix = blobToArray(cameraMatrix)
+        self.distCoeffs = blobToArray(distCoeffs)
+        self.names = list(intrinsicNames) + (names.split(',') if names else [])
+        self.arrays = None
+
+    def __getitem__(self, name):
+        if name == 'cameraMatrix':
+            return self.cameraMatrix
+        if name == 'distCoeffs':
+            return self.distCoeffs
+        if self.arrays is None:
+            self.arrays = self.database.loadArrays(self.id)
+        if name not in self.arrays:
+            raise KeyError(f'{name} is not in calibration {self.id} of camera {self.cameraId}')
+        return self.arrays[name]
+
+    def __contains__(self, name):
+        return name in self.names
+
+class CalibrationDatabase:
+    # Every calibration of every camera in one SQLite file, keyed by camera ID, resolution and time, so a new
+    # calibration never replaces an old one. The latest table points at the newest calibration of each camera and
+    # resolution and is updated in the same transaction as the insert, so latest() is a single primary key lookup and
+    # readers never see a half-written calibration. WAL mode lets trackers read while a calibration is being saved.
+    def __init__(self, path=databaseName):
+        self.path = path
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        with self.connection:
+            self.connection.execute('PRAGMA journal_mode=WAL')
+            self.connection.execute("""CREATE TABLE IF NOT EXISTS calibrations (
+                id INTEGER PRIMARY KEY, cameraId TEXT NOT NULL, width INTEGER NOT NULL, height INTEGER NOT NULL,
+                createdAt REAL NOT NULL, rms REAL, cameraMatrix BLOB NOT NULL, distCoeffs BLOB NOT NULL, names TEXT)""")
+            self.connection.execute("""CREATE TABLE IF NOT EXISTS calibrationArrays (
+                calibrationId INTEGER NOT NULL REFERENCES calibrations(id), name TEXT NOT NULL, data BLOB NOT NULL,
+                PRIMARY KEY (calibrationId, name)) WITHOUT ROWID""")
+            self.connection.execute("""CREATE TABLE IF NOT EXISTS latest (
+                cameraId TEXT NOT NULL, width INTEGER NOT NULL, height INTEGER NOT NULL, calibrationId INTEGER NOT NULL,
+                createdAt REAL NOT NULL, PRIMARY KEY (cameraId, width, height)) WITHOUT ROWID""")
+            self.connection.execute('CREATE INDEX IF NOT EXISTS calibrationHistory ON calibrations (cameraId, createdAt)')
+
+    def add(self, cameraId, imageSize, cameraMatrix, distCoeffs, rms=None, createdAt=None, **arrays):
+        # Saves a new calibration and returns its id. arrays are the per-view results such as rvecs and tvecs.
+        width, height = (int(v) for v in imageSize)
+        createdAt = time.time() if createdAt is None else createdAt
+        arrays = {name: np.asarray(array) for name, array in arrays.items() if array is not None}
+        with self.lock, self.connection:
+            cursor = self.connection.execute(
+                'INSERT INTO calibrations (cameraId, width, height, createdAt, rms, cameraMatrix, distCoeffs, names) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                (cameraId, width, height, createdAt, None if rms is None else float(rms), arrayToBlob(cameraMatrix),
+                 arrayToBlob(distCoeffs), ','.join(arrays)))
+            calibrationId = cursor.lastrowid
+            self.connection.executemany('INSERT INTO calibrationArrays VALUES (?, ?, ?)',
+                                        [(calibrationId, name, arrayToBlob(array)) for name, array in arrays.items()])
+            # Calibrations imported with an older createdAt go into the history without becoming the latest
+            self.connection.execute(
+                'INSERT INTO latest VALUES (?, ?, ?, ?, ?) ON CONFLICT (cameraId, width, height) DO UPDATE SET '
+                'calibrationId = excluded.calibrationId, createdAt = excluded.createdAt WHERE excluded.createdAt >= latest.createdAt',
+                (cameraId, width, height, calibrationId, createdAt))
+        return calibrationId
+
+    def addNpz(self, cameraId, imageSize, path, createdAt=None):
+        # Imports a cameraCalibration.npz, dated by its modification time unless createdAt is given
+        with np.load(path) as data:
+            arrays = {name: data[name] for name in data.files}
+        rms = arrays.pop('rms', None)
+        if createdAt is None:
+            createdAt = os.path.getmtime(path)
+        return self.add(cameraId, imageSize, arrays.pop('cameraMatrix'), arrays.pop('distCoeffs'), rms, createdAt, **arrays)
+
+    def query(self, sql, parameters=()):
+        with self.lock:
+            return self.connection.execute(sql, parameters).fetchall()
+
+    def get(self, calibrationId):
+        rows = self.query('SELECT id, cameraId, width, height, createdAt, rms, cameraMatrix, distCoeffs, names '
+                          'FROM calibrations WHERE id = ?', (calibrationId,))
+        return StoredCalibration(self, rows[0]) if rows else None
+
+    def latest(self, cameraId, imageSize=None):
+        # The newest calibration of a camera at imageSize (w, h), or at any resolution without it. None if there is none.
+        if imageSize is None:
+            rows = self.query('SELECT calibrationId FROM latest WHERE cameraId = ? ORDER BY createdAt DESC LIMIT 1', (cameraId,))
+        else:
+            rows = self.query('SELECT calibrationId FROM latest WHERE cameraId = ? AND width = ? AND height = ?',
+                              (cameraId, int(imageSize[0]), int(imageSize[1])))
+        return self.get(rows[0][0]) if rows else None
+
+    def history(self, cameraId, imageSize=None, since=None, until=None, limit=None):
+        # Calibrations of a camera, newest first, optionally only at one resolution and between two time.time() values
+        sql = 'SELECT id, cameraId, width, height, createdAt, rms, cameraMatrix, distCoeffs, names FROM calibrations WHERE cameraId = ?'
+        parameters = [cameraId]
+        if imageSize is not None:
+            sql += ' AND width = ? AND height = ?'
+            parameters += [int(imageSize[0]), int(imageSize[1])]
+        if since is not None:
+            sql += ' AND createdAt >= ?'
+            parameters.append(since)
+        if until is not None:
+            sql += ' AND createdAt < ?'
+            parameters.append(until)
+        sql += ' ORDER BY createdAt DESC'
+        if limit is not None:
+            sql += ' LIMIT ?'
+            parameters.append(int(limit))
+        return [StoredCalibration(self, row) for row in self.query(sql, parameters)]
+
+    def cameras(self):
+        return [row[0] for row in self.query('SELECT DISTINCT cameraId FROM latest ORDER BY cameraId')]
+
+    def loadArrays(self, calibrationId):
+        rows = self.query('SELECT name, data FROM calibrationArrays WHERE calibrationId = ?', (calibrationId,))
+        return {name: blobToArray(data) for name, data in rows}
+
+    def exportNpz(self, calibration, path):
+        # Writes a calibration as the cameraCalibration.npz the trackers load, through a temporary file so a tracker
+        # starting at the same time never reads half a file
+        arrays = {name: calibration[name] for name in calibration.names}
+        if calibration.rms is not None:
+            arrays['rms'] = calibration.rms
+        tmpPath = f'{path}.{os.getpid()}.tmp.npz'
+        np.savez(tmpPath, **arrays)
+        os.replace(tmpPath, path)
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+def benchmarkCalibrationDatabase(numCameras=300, versionsPerCamera=10):
+    # Compares finding a camera's latest calibration in a directory of <cameraId>_<time>.npz files, the way copies
+    # of cameraCalibration.npz are kept apart today, with CalibrationDatabase.latest
+    rng = np.random.default_rng(0)
+    cameraIds = [f'camera{i:03d}' for i in range(numCameras)]
+    with tempfile.TemporaryDirectory() as directory:
+        database = CalibrationDatabase(os.path.join(directory, databaseName))
+        start = time.perf_counter()
+        for version in range(versionsPerCamera):
+            for cameraId in cameraIds:
+                cameraMatrix = np.array([[900.0, 0, 640], [0, 900, 360], [0, 0, 1]]) + rng.normal(size=(3, 3))
+                distCoeffs = rng.normal(0, 0.1, (1, 5))
+                rvecs, tvecs = rng.normal(size=(40, 3, 1)), rng.normal(size=(40, 3, 1))
+                createdAt = 1.7e9 + version * 86400
+                database.add(cameraId, (1280, 720), cameraMatrix, distCoeffs, 0.3, createdAt, rvecs=rvecs, tvecs=tvecs)
+                np.savez(os.path.join(directory, f'{cameraId}_{int(createdAt)}.npz'), cameraMatrix=cameraMatrix,
+                         distCoeffs=distCoeffs, rvecs=rvecs, tvecs=tvecs, rms=0.3)
+        addTime = (time.perf_counter() - start) / (numCameras * versionsPerCamera) * 1000
+
+        lookups = cameraIds[::max(1, numCameras // 50)]
+        start = time.perf_counter()
+        for cameraId in lookups:
+            path = max(glob.glob(os.path.join(directory, f'{cameraId}_*.npz')))
+            with np.load(path) as data:
+                scanned = data['cameraMatrix']
+        scanTime = (time.perf_counter() - start) / len(lookups) * 1000
+
+        start = time.perf_counter()
+        for cameraId in lookups:
+            latest = database.latest(cameraId, (1280, 720))
+        databaseTime = (time.perf_counter() - start) / len(lookups) * 1000
+
+        same = np.array_equal(latest.cameraMatrix, scanned)
+        historyLength = len(database.history(cameraIds[0]))
+        database.close()
+
+    print(f'{numCameras} cameras x {versionsPerCamera} calibrations: add {addTime:.2f} ms each (with an .npz copy), '
+          f'latest from directory scan {scanTime:.2f} ms, from database {databaseTime:.3f} ms '
+          f'({scanTime / databaseTime:.0f}x), same result: {same}, history of one camera: {historyLength} calibrations')
+
+def benchmarkCalibrationLoading(numViews=1000, cornersPerView=54, repeats=20):
+    # Compares np.load of every array, as the trackers used to get their intrinsics, with getCalibration for a file
+    # with numViews views and their per-corner residuals, the largest thing calibrationCalculation saves
+    rng = np.random.default_rng(0)
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'cameraCalibration.npz')
+        np.savez(path, cameraMatrix=np.eye(3), distCoeffs=np.zeros((1, 5)), rvecs=rng.normal(size=(numViews, 3, 1)),
+                 tvecs=rng.normal(size=(numViews, 3, 1)), rms=0.3, perViewErrors=rng.random(numViews),
+                 perCornerResiduals=rng.normal(size=(numViews, cornersPerView, 2)))
+
+        start = time.perf_counter()
+        for _ in range(repeats):
+            with np.load(path) as data:
+                arrays = {name: data[name] for name in data.files}
+        loadAllTime = (time.perf_counter() - start) / repeats * 1000
+
+        start = time.perf_counter()
+        for _ in range(repeats):
+            calibrationStore.calibrations.clear()
+            calibration = getCalibration(path)
+        firstTime = (time.perf_counter() - start) / repeats * 1000
+
+        start = time.perf_counter()
+        for _ in range(repeats * 50):
+            getCalibration(path)
+        cachedTime = (time.perf_counter() - start) / (repeats * 50) * 1000
+
+        same = all(np.array_equal(calibration[name], arrays[name]) for name in arrays)
+        size = os.path.getsize(path) / 1e6
+        del calibration
+        calibrationStore.calibrations.clear()
+
+    print(f'{size:.1f} MB calibration with {numViews} views: np.load of every array {loadAllTime:.2f} ms, '
+          f'first getCalibration {firstTime:.2f} ms ({loadAllTime / firstTime:.1f}x), cached {cachedTime * 1000:.1f} us, '
+          f'memory-mapped arrays match: {same}')
+
+if __name__ == "__main__":
+    for numViews in (100, 1000, 10000):
+        benchmarkCalibrationLoading(numViews)
+    benchmarkCalibrationDatabase()
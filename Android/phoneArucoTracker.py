@@ -1,102 +1,197 @@
-import requests
+import time
 import cv2
 import cv2.aruco as aruco
 import numpy as np
-import imutils
-
-# Load camera calibration data
-with np.load('cameraCalibration.npz') as data:
-    cameraMatrix = data['cameraMatrix']
-    distCoeffs = data['distCoeffs']
-
-def getEulerAngles(rvec):
-    rotationMatrix, _ = cv2.Rodrigues(rvec)
-    sy = np.sqrt(rotationMatrix[0, 0] * rotationMatrix[0, 0] + rotationMatrix[1, 0] * rotationMatrix[1, 0])
-    
-    singular = sy < 1e-6
-
-    if not singular:
-        x = np.arctan2(rotationMatrix[2, 1], rotationMatrix[2, 2])
-        y = np.arctan2(-rotationMatrix[2, 0], sy)
-        z = np.arctan2(rotationMatrix[1, 0], rotationMatrix[0, 0])
-    else:
-        x = np.arctan2(-rotationMatrix[1, 2], rotationMatrix[1, 1])
-        y = np.arctan2(-rotationMatrix[2, 0], sy)
-        z = 0
-
-    return np.degrees(x), np.degrees(y), np.degrees(z)
-
-def arucoMarkerDetection(cameraMatrix, distCoeffs, url):
-    arucoDict = aruco.getPredefinedDictionary(aruco.DICT_6X6_250)
-    parameters = aruco.DetectorParameters()
-    markerLength = 0.2  # Marker side length in meters (25 mm)
-
-    while True:
-        imgResp = requests.get(url)
-        imgArr = np.array(bytearray(imgResp.content), dtype=np.uint8)
-        frame = cv2.imdecode(imgArr, -1)
-        frame = imutils.resize(frame, width=1000, height=1800)
-
-        if frame is None:
-            print("Error: Failed to read frame from camera.")
-            break
-
-        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-
-        detector = aruco.ArucoDetector(arucoDict, parameters)
-        markerCorners, markerIds, rejectedCandidates = detector.detectMarkers(gray)
-
+from calibrationStore import getCalibration
+from markerPose import PoseFileSink, estimateMarkerPoses, makeRecords
+from frameSource import HttpFrameSource
+
+class ArucoTracker:
+    # Owns everything that stays the same from one frame to the next: the dictionary, the detector and the gray buffer.
+    # process() only detects and estimates poses, so it can be driven without a window; draw() adds the overlay.
+    # With roiTracking, markers seen in the last frame are only searched for in padded regions around where they are
+    # predicted to be, and the whole frame is searched every fullSearchInterval frames or as soon as a marker is lost.
+    def __init__(self, cameraMatrix, distCoeffs, markerLength=0.2, dictionary=aruco.DICT_6X6_250, roiTracking=False,
+                 roiPadding=0.5, fullSearchInterval=10):
+        self.cameraMatrix = cameraMatrix
+        self.distCoeffs = distCoeffs
+        self.markerLength = markerLength  # Marker side length in meters
+        self.roiTracking = roiTracking
+        self.roiPadding = roiPadding  # Padding around each predicted marker, as a fraction of its size
+        self.fullSearchInterval = fullSearchInterval  # Frames between full-frame searches, which pick up new markers
+        self.tracks = {}  # Marker id -> (corners, corner motion per frame) from the last frame it was seen in
+        self.framesSinceFullSearch = 0
+        self.arucoDict = aruco.getPredefinedDictionary(dictionary)
+        self.parameters = aruco.DetectorParameters()
+        self.detector = aruco.ArucoDetector(self.arucoDict, self.parameters)
+        self.gray = None
+
+    def toGray(self, frame):
+        # Converts into the same buffer every frame, it is only reallocated when the frame size changes. Frames that
+        # are already gray, such as a Picamera2 Y plane, are used as they are.
+        if frame.ndim == 2:
+            return frame
+        if self.gray is None or self.gray.shape != frame.shape[:2]:
+            self.gray = np.empty(frame.shape[:2], np.uint8)
+        return cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY, dst=self.gray)
+
+    def predictRegions(self, frameShape):
+        # Moves every tracked marker on by its last motion and pads its bounding box, overlapping boxes are merged
+        height, width = frameShape[:2]
+        regions = []
+        for corners, motion in self.tracks.values():
+            predicted = corners + motion
+            low, high = predicted.min(axis=0), predicted.max(axis=0)
+            pad = self.roiPadding * (high - low).max() + np.abs(motion).max()
+            box = [max(int(low[0] - pad), 0), max(int(low[1] - pad), 0), min(int(high[0] + pad) + 1, width), min(int(high[1] + pad) + 1, height)]
+
+            merged = True
+            while merged:
+                merged = False
+                for other in regions:
+                    if box[0] < other[2] and other[0] < box[2] and box[1] < other[3] and other[1] < box[3]:
+                        regions.remove(other)
+                        box = [min(box[0], other[0]), min(box[1], other[1]), max(box[2], other[2]), max(box[3], other[3])]
+                        merged = True
+                        break
+            regions.append(box)
+        return regions
+
+    def detectInRegions(self, gray):
+        # Runs the detector on each predicted region and maps the corners back to full-frame coordinates
+        markerCorners, markerIds = [], []
+        for x0, y0, x1, y1 in self.predictRegions(gray.shape):
+            corners, ids, rejectedCandidates = self.detector.detectMarkers(gray[y0:y1, x0:x1])
+            if ids is None:
+                continue
+            offset = np.array([x0, y0], dtype=np.float32)
+            for c, markerId in zip(corners, ids):
+                if markerId[0] not in markerIds:
+                    markerCorners.append(c + offset)
+                    markerIds.append(markerId[0])
+        return tuple(markerCorners), np.array(markerIds, dtype=np.int32).reshape(-1, 1) if markerIds else None
+
+    def updateTracks(self, markerCorners, markerIds):
+        tracks = {}
         if markerIds is not None:
-            aruco.drawDetectedMarkers(frame, markerCorners, markerIds)
-            for i in range(len(markerIds)):
-                rvec, tvec, _ = aruco.estimatePoseSingleMarkers(markerCorners[i], markerLength, cameraMatrix, distCoeffs)
-                cv2.drawFrameAxes(frame, cameraMatrix, distCoeffs, rvec[0], tvec[0], 0.1)
-
-                c = markerCorners[i][0]
-                centerX = int(np.mean(c[:, 0]))
-                centerY = int(np.mean(c[:, 1]))
-
-                cv2.circle(frame, (centerX, centerY), 5, (255, 0, 0), -1)
-                cv2.line(frame, (centerX, centerY), (centerX + 50, centerY), (0, 0, 255), 2)
-                cv2.line(frame, (centerX, centerY), (centerX, centerY + 50), (0, 255, 0), 2)
-
-                cv2.putText(frame, f"ID: {markerIds[i][0]}", (centerX - 10, centerY - 10), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0, 255, 0), 2)
-
-                distance = np.linalg.norm(tvec[0])
-                cv2.putText(frame, f"Distance: {distance:.2f}m", (centerX - 10, centerY + 20), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0, 165, 255), 2)
-
-                yaw, pitch, roll = getEulerAngles(rvec[0])
-                cv2.putText(frame, f"Yaw: {yaw:.2f}", (centerX - 10, centerY + 40), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0, 165, 255), 2)
-                cv2.putText(frame, f"Pitch: {pitch:.2f}", (centerX - 10, centerY + 60), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0, 165, 255), 2)
-                cv2.putText(frame, f"Roll: {roll:.2f}", (centerX - 10, centerY + 80), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0, 165, 255), 2)
-
-
-                frameCenterX, frameCenterY = frame.shape[1] // 2, frame.shape[0] // 2
-                moveText = ""
-                if centerX < frameCenterX - 50:
-                    moveText = "Move Right"
-                    cv2.putText(frame, moveText, (50, 50), cv2.FONT_HERSHEY_SIMPLEX, 1, (0, 0, 255), 3)
-                elif centerX > frameCenterX + 50:
-                    moveText = "Move Left"
-                    cv2.putText(frame, moveText, (50, 50), cv2.FONT_HERSHEY_SIMPLEX, 1, (0, 0, 255), 3)
-                if centerY < frameCenterY - 50:
-                    moveText = "Move Down"
-                    cv2.putText(frame, moveText, (50, 100), cv2.FONT_HERSHEY_SIMPLEX, 1, (0, 0, 255), 3)
-                elif centerY > frameCenterY + 50:
-                    moveText = "Move Up"
-                    cv2.putText(frame, moveText, (50, 100), cv2.FONT_HERSHEY_SIMPLEX, 1, (0, 0, 255), 3)
-
-                print(f"Marker ID: {markerIds[i][0]} Center: ({centerX}, {centerY})")
-                print(f"Rotation Vector: {rvec}")
-                print(f"Translation Vector: {tvec}")
-                print(f"Yaw: {yaw:.2f}, Pitch: {pitch:.2f}, Roll: {roll:.2f}")
-
-        cv2.imshow('Aruco Marker Detection', frame)
-
-        if cv2.waitKey(1) & 0xFF == 27:
-            break
-
-    cv2.destroyAllWindows()
-
-url = "http://192.168.1.175:8080/shot.jpg"  # Replace with your URL
-arucoMarkerDetection(cameraMatrix, distCoeffs, url)
+            for corners, markerId in zip(markerCorners, markerIds.ravel()):
+                corners = corners.reshape(4, 2)
+                previous = self.tracks.get(markerId)
+                tracks[markerId] = (corners, np.zeros((4, 2), np.float32) if previous is None else corners - previous[0])
+        self.tracks = tracks
+
+    def process(self, frame):
+        # Returns the markers found in frame as a structured array of markerPose.poseDtype records, one per marker
+        gray = self.toGray(frame)
+        markerCorners, markerIds = None, None
+        if self.roiTracking and self.tracks and self.framesSinceFullSearch < self.fullSearchInterval:
+            markerCorners, markerIds = self.detectInRegions(gray)
+            self.framesSinceFullSearch += 1
+            found = set() if markerIds is None else set(markerIds.ravel())
+            if not found.issuperset(self.tracks):
+                markerIds = None  # A marker was lost, search the whole frame for it
+
+        if markerIds is None:
+            markerCorners, markerIds, rejectedCandidates = self.detector.detectMarkers(gray)
+            self.framesSinceFullSearch = 0
+
+        if self.roiTracking:
+            self.updateTracks(markerCorners, markerIds)
+        return estimateMarkerPoses(markerCorners, markerIds, self.markerLength, self.cameraMatrix, self.distCoeffs)
+
+    def draw(self, frame, markers):
+        if len(markers) == 0:
+            return frame
+
+        aruco.drawDetectedMarkers(frame, markers['corners'][:, None], markers['id'][:, None])
+        for marker in markers:
+            cv2.drawFrameAxes(frame, self.cameraMatrix, self.distCoeffs, marker['rvec'], marker['tvec'], 0.1)
+
+            centerX, centerY = int(marker['center'][0]), int(marker['center'][1])
+            cv2.circle(frame, (centerX, centerY), 5, (255, 0, 0), -1)
+            cv2.line(frame, (centerX, centerY), (centerX + 50, centerY), (0, 0, 255), 2)
+            cv2.line(frame, (centerX, centerY), (centerX, centerY + 50), (0, 255, 0), 2)
+
+            cv2.putText(frame, f"ID: {marker['id']}", (centerX - 10, centerY - 10), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0, 255, 0), 2)
+            cv2.putText(frame, f"Distance: {marker['distance']:.2f}m", (centerX - 10, centerY + 20), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0, 165, 255), 2)
+
+            yaw, pitch, roll = marker['eulerAngles']
+            cv2.putText(frame, f"Yaw: {yaw:.2f}", (centerX - 10, centerY + 40), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0, 165, 255), 2)
+            cv2.putText(frame, f"Pitch: {pitch:.2f}", (centerX - 10, centerY + 60), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0, 165, 255), 2)
+            cv2.putText(frame, f"Roll: {roll:.2f}", (centerX - 10, centerY + 80), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0, 165, 255), 2)
+
+            frameCenterX, frameCenterY = frame.shape[1] // 2, frame.shape[0] // 2
+            moveText = ""
+            if centerX < frameCenterX - 50:
+                moveText = "Move Right"
+                cv2.putText(frame, moveText, (50, 50), cv2.FONT_HERSHEY_SIMPLEX, 1, (0, 0, 255), 3)
+            elif centerX > frameCenterX + 50:
+                moveText = "Move Left"
+                cv2.putText(frame, moveText, (50, 50), cv2.FONT_HERSHEY_SIMPLEX, 1, (0, 0, 255), 3)
+            if centerY < frameCenterY - 50:
+                moveText = "Move Down"
+                cv2.putText(frame, moveText, (50, 100), cv2.FONT_HERSHEY_SIMPLEX, 1, (0, 0, 255), 3)
+            elif centerY > frameCenterY + 50:
+                moveText = "Move Up"
+                cv2.putText(frame, moveText, (50, 100), cv2.FONT_HERSHEY_SIMPLEX, 1, (0, 0, 255), 3)
+        return frame
+
+def printMarkers(markers):
+    for marker in markers:
+        yaw, pitch, roll = marker['eulerAngles']
+        print(f"Marker ID: {marker['id']} Center: ({int(marker['center'][0])}, {int(marker['center'][1])})")
+        print(f"Rotation Vector: {marker['rvec']}")
+        print(f"Translation Vector: {marker['tvec']}")
+        print(f"Yaw: {yaw:.2f}, Pitch: {pitch:.2f}, Roll: {roll:.2f}")
+
+def arucoMarkerDetection(cameraMatrix, distCoeffs, url, headless=False, sink=None, drawEveryN=1):
+    # headless skips all drawing and printing, stop it with Ctrl+C. sink gets the pose records of every frame, and with
+    # a display attached only every drawEveryN-th frame is drawn and printed.
+
+    # Marker side length in meters (20cm), set roiTracking=False to search the whole frame every time
+    tracker = ArucoTracker(cameraMatrix, distCoeffs, markerLength=0.2, roiTracking=True)
+
+    source = HttpFrameSource(url, targetWidth=1000)  # Decodes straight to the 1000px wide display size
+    frameIndex = 0
+    try:
+        while True:
+            frame = source.read()
+            if frame is None:
+                print("Error: Failed to read frame from camera.")
+                break
+
+            timestamp = time.time()
+            markers = tracker.process(frame)
+            if sink is not None:
+                sink.write(makeRecords(markers, timestamp, frameIndex))
+            frameIndex += 1
+            if headless or frameIndex % drawEveryN != 0:
+                continue
+
+            printMarkers(markers)
+            cv2.imshow('Aruco Marker Detection', tracker.draw(frame, markers))
+
+            if cv2.waitKey(1) & 0xFF == 27:
+                break
+    except KeyboardInterrupt:
+        pass
+
+    source.close()
+    if not headless:
+        cv2.destroyAllWindows()
+
+if __name__ == "__main__":
+    # Load camera calibration data, only the intrinsics are read from the file
+    calibration = getCalibration('cameraCalibration.npz')
+    cameraMatrix = calibration.cameraMatrix
+    distCoeffs = calibration.distCoeffs
+
+    url = "http://192.168.1.175:8080/shot.jpg"  # Replace with your URL, ending in /shot.jpg or /video for the MJPEG stream
+    headless = False  # Skip all drawing and printing, e.g. on a machine without a display
+    outputPath = None  # e.g. 'poses.ndjson' or 'poses.bin' to save the poses of every frame
+    drawEveryN = 1  # With a display, only draw and print every Nth frame
+
+    sink = None if outputPath is None else PoseFileSink(outputPath, 'ndjson' if outputPath.endswith('.ndjson') else 'binary')
+    arucoMarkerDetection(cameraMatrix, distCoeffs, url, headless, sink, drawEveryN)
+    if sink is not None:
+        sink.close()
@@ -1,53 +1,164 @@
-import requests
 import cv2
 import numpy as np
-import imutils
 import os
 import time
+from frameSource import HttpFrameSource
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from phoneCalibrationCalculation import CaptureGate, IncrementalCalibrator, subPixWinSize, subPixCriteria, cornerSidecarSuffix
 
-def captureCalibrationImages(url, outputDir):
+class AsyncImageWriter:
+    # Encodes and writes captured images on a small thread pool, OpenCV releases the GIL while encoding.
+    # submit() blocks once maxPending writes are outstanding, so a slow disk slows capturing down instead of filling memory.
+    def __init__(self, imageFormat='png', pngCompression=1, numWorkers=2, maxPending=8, onWritten=None):
+        if imageFormat not in ('png', 'webp', 'npy'):
+            raise ValueError(f"Unsupported image format '{imageFormat}', use 'png', 'webp' or 'npy'")
+
+        self.imageFormat = imageFormat
+        self.extension = '.' + imageFormat
+        if imageFormat == 'png':
+            self.params = [cv2.IMWRITE_PNG_COMPRESSION, pngCompression]
+        elif imageFormat == 'webp':
+            self.params = [cv2.IMWRITE_WEBP_QUALITY, 101]  # Any quality above 100 selects lossless WebP
+        else:
+            self.params = []
+
+        self.onWritten = onWritten
+        self.executor = ThreadPoolExecutor(max_workers=numWorkers)
+        self.slots = threading.BoundedSemaphore(maxPending)
+        self.lock = threading.Lock()
+        self.pending = 0
+
+    def submit(self, basePath, image, corners=None):
+        # basePath is the image path without its extension, the corners are saved next to it for calibrationCalculation
+        self.slots.acquire()
+        with self.lock:
+            self.pending += 1
+        future = self.executor.submit(self.write, basePath, image, corners)
+        future.add_done_callback(self.finished)
+        return basePath + self.extension
+
+    def write(self, basePath, image, corners):
+        # The corners go first so anything watching the directory never sees an image without them
+        if corners is not None:
+            np.save(basePath + cornerSidecarSuffix, corners)
+
+        imagePath = basePath + self.extension
+        if self.imageFormat == 'npy':
+            np.save(imagePath, image)
+        elif not cv2.imwrite(imagePath, image, self.params):
+            raise OSError(f'Failed to write {imagePath}')
+        return imagePath
+
+    def finished(self, future):
+        with self.lock:
+            self.pending -= 1
+        self.slots.release()
+        if future.exception() is not None:
+            print(f'Error: {future.exception()}')
+            return
+
+        print(f'Captured {future.result()}')
+        if self.onWritten is not None:
+            self.onWritten(future.result())
+
+    def close(self):
+        # Waits until every submitted image is on disk
+        self.executor.shutdown(wait=True)
+
+# What the preview shows when the CaptureGate turns a frame away
+gateMessages = {
+    'moving': 'Hold the Chessboard Still',
+    'blurry': 'Out of Focus',
+    'unchanged': 'Captured, Move to a New Pose',
+    'duplicate': 'Pose Already Captured',
+}
+
+def captureCalibrationImages(url, outputDir, imageFormat='png', pngCompression=1, useCaptureGate=True):
     if not os.path.exists(outputDir):
         os.makedirs(outputDir)
 
     chessboardSize = (9, 6)  # Number of inner corners per a chessboard row and column
+    squareSize = 0.025  # Square size in meters, used for the live calibration estimate
 
     print("Align the chessboard pattern and the image will be captured automatically.")
 
     lastCaptureTime = time.time()
     imageCount = 0
+    calibrator = None  # Live calibration estimate, updated as images are captured
+    writer = AsyncImageWriter(imageFormat, pngCompression)
+    # Frames that are moving, blurry or unchanged since the last capture skip detection, captured poses aren't saved again
+    gate = CaptureGate(chessboardSize) if useCaptureGate else None
+    source = HttpFrameSource(url, targetWidth=1000)  # Decodes straight to the 1000px wide display size
     while True:
-        imgResp = requests.get(url)
-        imgArr = np.array(bytearray(imgResp.content), dtype=np.uint8)
-        img = cv2.imdecode(imgArr, -1)
-        img = imutils.resize(img, width=1000, height=1800)
-
+        img = source.read()
+        if img is None:
+            break
         gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-        ret, corners = cv2.findChessboardCorners(gray, chessboardSize, None)
+        gateStatus = None if gate is None else gate.check(gray)
+        if gateStatus is None:
+            ret, corners = cv2.findChessboardCorners(gray, chessboardSize, None)
+        else:
+            ret, corners = False, None
 
         if ret:
             imgCopy = img.copy()
             cv2.drawChessboardCorners(imgCopy, chessboardSize, corners, ret)
-            cv2.putText(imgCopy, 'Ready to Capture', (10, 30), cv2.FONT_HERSHEY_SIMPLEX, 1, (0, 255, 0), 2, cv2.LINE_AA)
 
             currentTime = time.time()
             if currentTime - lastCaptureTime > 1:  # Check if 1 second has passed since last capture
-                imageCount += 1
-                imagePath = os.path.join(outputDir, f'image_{imageCount}.png')
-                cv2.imwrite(imagePath, img)  # Save the original frame without the added lines or text
-                print(f'Captured {imagePath}')
-                lastCaptureTime = currentTime  # Update last capture time
+                if gate is not None and not gate.isNovel(corners, gray.shape[::-1]):
+                    gateStatus = 'duplicate'
+                else:
+                    imageCount += 1
+                    # Save the original frame without the added lines or text, the corners are saved alongside it
+                    writer.submit(os.path.join(outputDir, f'image_{imageCount}'), img, corners)
+                    lastCaptureTime = currentTime  # Update last capture time
+                    if gate is not None:
+                        gate.add(corners, gray.shape[::-1])
 
+                    # Feed the refined corners to the live calibration estimate
+                    if calibrator is None:
+                        calibrator = IncrementalCalibrator(chessboardSize, squareSize, gray.shape[::-1])
+                    calibrator.addCorners(cv2.cornerSubPix(gray, corners.copy(), subPixWinSize, (-1, -1), subPixCriteria))
+
+            if gateStatus is None:
+                cv2.putText(imgCopy, 'Ready to Capture', (10, 30), cv2.FONT_HERSHEY_SIMPLEX, 1, (0, 255, 0), 2, cv2.LINE_AA)
+            else:
+                cv2.putText(imgCopy, gateMessages[gateStatus], (10, 30), cv2.FONT_HERSHEY_SIMPLEX, 1, (0, 0, 255), 2, cv2.LINE_AA)
         else:
-            cv2.putText(img, 'Align the Chessboard', (10, 30), cv2.FONT_HERSHEY_SIMPLEX, 1, (0, 0, 255), 2, cv2.LINE_AA)
+            message = gateMessages.get(gateStatus, 'Align the Chessboard')
+            cv2.putText(img, message, (10, 30), cv2.FONT_HERSHEY_SIMPLEX, 1, (0, 0, 255), 2, cv2.LINE_AA)
+
+        display = imgCopy if ret else img
+        if calibrator is not None:
+            if calibrator.update():
+                print(f'Live calibration: {calibrator.status()}')
+            cv2.putText(display, calibrator.status(), (10, 60), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (255, 255, 0), 1, cv2.LINE_AA)
 
-        cv2.imshow("Android_cam", imgCopy if ret else img)
+        cv2.imshow("Android_cam", display)
 
         if cv2.waitKey(1) & 0xFF == 27:  # Exit on 'Esc' key
             break
 
+    source.close()
+    writer.close()
+
+    # Keep the live estimate next to the images so cameraCalibration.npz in the working directory is never overwritten
+    if calibrator is not None:
+        calibrator.update(force=True)
+        calibrator.close()
+        if calibrator.cameraMatrix is not None:
+            calibrationPath = os.path.join(outputDir, 'cameraCalibration.npz')
+            calibrator.save(calibrationPath)
+            print(f'Saved live calibration estimate ({calibrator.status()}) to {calibrationPath}')
+
     cv2.destroyAllWindows()
 
-url = "http://192.168.1.175:8080/shot.jpg"  # Replace with your URL
+url = "http://192.168.1.175:8080/shot.jpg"  # Replace with your URL, ending in /shot.jpg or /video for the MJPEG stream
 timestamp = time.strftime("%Y%m%d-%H%M%S")
 outputDir = f'calibration_images_{timestamp}'
-captureCalibrationImages(url, outputDir)
+imageFormat = 'png'  # 'png', 'webp' (lossless) or 'npy' (raw array, fastest to write but largest)
+pngCompression = 1  # PNG compression level from 0 to 9, higher is smaller but slower to encode
+useCaptureGate = True  # Skip frames that are moving, out of focus or show a pose that was already captured
+captureCalibrationImages(url, outputDir, imageFormat, pngCompression, useCaptureGate)
@@ -1,20 +1,19 @@
-import requests 
 import cv2 
-import numpy as np 
-import imutils 
+from frameSource import HttpFrameSource
 
-# Replace the below URL with your own. Make sure to add "/shot.jpg" at last. 
+# Replace the below URL with your own. Make sure to add "/shot.jpg" at last, or "/video" to use the MJPEG stream. 
 url = "http://192.168.1.175:8080/shot.jpg"
+source = HttpFrameSource(url, targetWidth=1000)  # Decodes straight to the 1000px wide display size
 
 while True: 
-	img_resp = requests.get(url) 
-	img_arr = np.array(bytearray(img_resp.content), dtype=np.uint8) 
-	img = cv2.imdecode(img_arr, -1) 
-	img = imutils.resize(img, width=1000, height=1800) 
+	img = source.read() 
+	if img is None: 
+		break
 	cv2.imshow("androidCam", img) 
 
 	# Press Esc key to exit 
 	if cv2.waitKey(1) == 27: 
 		break
 
+source.close()
 cv2.destroyAllWindows() 
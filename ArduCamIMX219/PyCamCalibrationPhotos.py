@@ -1,10 +1,233 @@
-from picamera2 import Picamera2, Preview
 import cv2
+import numpy as np
 import os
 import time
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from frameSource import PicameraFrameSource
+from PyCamCalibrationCalculation import CaptureGate, IncrementalCalibrator, subPixWinSize, subPixCriteria, cornerSidecarSuffix
+
+class LatestFrameQueue:
+    # Bounded queue that drops its oldest item when full, so a slow consumer always gets the newest frames
+    def __init__(self, maxSize=1):
+        self.items = deque(maxlen=maxSize)
+        self.condition = threading.Condition()
+        self.closed = False
+        self.dropped = 0
+
+    def put(self, item):
+        with self.condition:
+            if len(self.items) == self.items.maxlen:
+                self.dropped += 1
+            self.items.append(item)
+            self.condition.notify()
+
+    def get(self, timeout=None):
+        # Returns None once the queue is closed and empty, or when the timeout runs out
+        with self.condition:
+            self.condition.wait_for(lambda: self.items or self.closed, timeout)
+            return self.items.popleft() if self.items else None
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+    def __len__(self):
+        return len(self.items)
+
+class RateCounter:
+    # Counts events from any thread and reports how many arrived per second since the last report
+    def __init__(self):
+        self.count = 0
+        self.lastReport = time.monotonic()
+        self.lock = threading.Lock()
+
+    def tick(self):
+        with self.lock:
+            self.count += 1
+
+    def rate(self):
+        with self.lock:
+            now = time.monotonic()
+            rate = self.count / max(now - self.lastReport, 1e-6)
+            self.count = 0
+            self.lastReport = now
+            return rate
+
+class AsyncImageWriter:
+    # Encodes and writes captured images on a small thread pool, OpenCV releases the GIL while encoding.
+    # submit() blocks once maxPending writes are outstanding, so a slow disk slows capturing down instead of filling memory.
+    def __init__(self, imageFormat='png', pngCompression=1, numWorkers=2, maxPending=8, onWritten=None):
+        if imageFormat not in ('png', 'webp', 'npy'):
+            raise ValueError(f"Unsupported image format '{imageFormat}', use 'png', 'webp' or 'npy'")
+
+        self.imageFormat = imageFormat
+        self.extension = '.' + imageFormat
+        if imageFormat == 'png':
+            self.params = [cv2.IMWRITE_PNG_COMPRESSION, pngCompression]
+        elif imageFormat == 'webp':
+            self.params = [cv2.IMWRITE_WEBP_QUALITY, 101]  # Any quality above 100 selects lossless WebP
+        else:
+            self.params = []
+
+        self.onWritten = onWritten
+        self.executor = ThreadPoolExecutor(max_workers=numWorkers)
+        self.slots = threading.BoundedSemaphore(maxPending)
+        self.lock = threading.Lock()
+        self.pending = 0
+
+    def submit(self, basePath, image, corners=None):
+        # basePath is the image path without its extension, the corners are saved next to it for calibrationCalculation
+        self.slots.acquire()
+        with self.lock:
+            self.pending += 1
+        future = self.executor.submit(self.write, basePath, image, corners)
+        future.add_done_callback(self.finished)
+        return basePath + self.extension
+
+    def write(self, basePath, image, corners):
+        # The corners go first so anything watching the directory never sees an image without them
+        if corners is not None:
+            np.save(basePath + cornerSidecarSuffix, corners)
+
+        imagePath = basePath + self.extension
+        if self.imageFormat == 'npy':
+            np.save(imagePath, image)
+        elif not cv2.imwrite(imagePath, image, self.params):
+            raise OSError(f'Failed to write {imagePath}')
+        return imagePath
+
+    def finished(self, future):
+        with self.lock:
+            self.pending -= 1
+        self.slots.release()
+        if future.exception() is not None:
+            print(f'Error: {future.exception()}')
+            return
+
+        print(f'Captured {future.result()}')
+        if self.onWritten is not None:
+            self.onWritten(future.result())
+
+    def close(self):
+        # Waits until every submitted image is on disk
+        self.executor.shutdown(wait=True)
+
+class CapturePipeline:
+    # Grabber and detector each run on their own thread and images are written by an AsyncImageWriter, while the
+    # preview stays on the main thread. The frame queues drop their oldest frame when full, so a slow detection or
+    # disk write never stalls the camera.
+    # With a CaptureGate, frames that are moving, blurry or unchanged since the last capture skip detection, and poses
+    # that were already captured are not saved again.
+    def __init__(self, source, chessboardSize, squareSize, outputDir, captureInterval=1.0, imageFormat='png', pngCompression=1, gate=None):
+        self.source = source  # A frameSource.FrameSource, detection runs on source.toGray() of each frame
+        self.gate = gate
+        self.chessboardSize = chessboardSize
+        self.squareSize = squareSize
+        self.outputDir = outputDir
+        self.captureInterval = captureInterval
+
+        self.detectQueue = LatestFrameQueue()
+        self.previewQueue = LatestFrameQueue()
+        self.counters = {stage: RateCounter() for stage in ('grab', 'gated', 'detect', 'preview', 'write')}
+        self.writer = AsyncImageWriter(imageFormat, pngCompression, onWritten=lambda imagePath: self.counters['write'].tick())
+        self.running = threading.Event()
+        self.threads = [threading.Thread(target=target, daemon=True) for target in (self.grabLoop, self.detectLoop)]
+
+        self.detection = (False, None)  # Result of the most recent detection, read by the preview
+        self.gateStatus = None  # Why the gate turned the most recent frame away, if it did
+        self.calibrator = None  # Live calibration estimate, updated as images are captured
+        self.imageCount = 0
+
+    def start(self):
+        self.running.set()
+        for thread in self.threads:
+            thread.start()
+
+    def stop(self):
+        self.running.clear()
+        self.detectQueue.close()
+        self.previewQueue.close()
+        for thread in self.threads:
+            thread.join()
+        self.writer.close()
+
+    def grabLoop(self):
+        while self.running.is_set():
+            frame = self.source.read()
+            if frame is None:
+                print("Error: Failed to read frame from camera.")
+                self.running.clear()
+                break
+
+            self.counters['grab'].tick()
+            self.detectQueue.put(frame)
+            self.previewQueue.put(frame)
+
+    def detectLoop(self):
+        lastCaptureTime = time.time()  # To track the last capture time
+        while True:
+            frame = self.detectQueue.get()
+            if frame is None:
+                break
+
+            gray = self.source.toGray(frame)
+            self.gateStatus = None if self.gate is None else self.gate.check(gray)
+            if self.gateStatus is not None:
+                self.detection = (False, None)
+                self.counters['gated'].tick()
+            else:
+                ret, corners = cv2.findChessboardCorners(gray, self.chessboardSize, None)
+                self.detection = (ret, corners)
+                self.counters['detect'].tick()
+
+                currentTime = time.time()
+                if ret and currentTime - lastCaptureTime > self.captureInterval:  # Check if enough time has passed since last capture
+                    if self.gate is not None and not self.gate.isNovel(corners, gray.shape[::-1]):
+                        self.gateStatus = 'duplicate'
+                    else:
+                        self.capture(frame, gray, corners)
+                        lastCaptureTime = currentTime
+
+            if self.calibrator is not None and self.calibrator.update():
+                print(f'Live calibration: {self.calibrator.status()}')
+
+    def capture(self, frame, gray, corners):
+        self.imageCount += 1
+        # Save the original frame without the added lines or text, this blocks when the disk falls behind
+        self.writer.submit(os.path.join(self.outputDir, f'image_{self.imageCount}'), self.source.toBgr(frame), corners)
+        if self.gate is not None:
+            self.gate.add(corners, gray.shape[::-1])
+
+        # Feed the refined corners to the live calibration estimate
+        if self.calibrator is None:
+            self.calibrator = IncrementalCalibrator(self.chessboardSize, self.squareSize, gray.shape[::-1])
+        self.calibrator.addCorners(cv2.cornerSubPix(gray, corners.copy(), subPixWinSize, (-1, -1), subPixCriteria))
+
+    def stats(self):
+        rates = ', '.join(f'{stage} {counter.rate():.1f}' for stage, counter in self.counters.items())
+        stats = (f'FPS {rates} | queued detect {len(self.detectQueue)} write {self.writer.pending} | '
+                 f'dropped detect {self.detectQueue.dropped} preview {self.previewQueue.dropped}')
+        if self.gate is not None:
+            stats += f' | {self.gate.status()}'
+        return stats
+
+# What the preview shows when the CaptureGate turns a frame away
+gateMessages = {
+    'moving': 'Hold the Chessboard Still',
+    'blurry': 'Out of Focus',
+    'unchanged': 'Captured, Move to a New Pose',
+    'duplicate': 'Pose Already Captured',
+}
 
 def captureCalibrationImages():
     chessboardSize = (9, 6)  # The number of inner corners you will scan for on the printed chessboard
+    squareSize = 0.025  # Square size in meters, used for the live calibration estimate
+    imageFormat = 'png'  # 'png', 'webp' (lossless) or 'npy' (raw array, fastest to write but largest)
+    pngCompression = 1  # PNG compression level from 0 to 9, higher is smaller but slower to encode
+    useCaptureGate = True  # Skip frames that are moving, out of focus or show a pose that was already captured
     
     # Create a directory with a timestamp for saving calibration images
     timestamp = time.strftime("%Y%m%d-%H%M%S")
@@ -12,50 +235,43 @@ def captureCalibrationImages():
     if not os.path.exists(outputDir):
         os.makedirs(outputDir)
 
-    # Initialize Picamera2
-    picam2 = Picamera2()
-    
-    # Configure the camera
-    preview_config = picam2.create_preview_configuration(main={"size": (800, 600)})
-    picam2.configure(preview_config)
-    picam2.start()
+    # Detection runs on the Y plane of the camera's YUV420 buffer, only previewed and saved frames are converted to BGR
+    source = PicameraFrameSource((800, 600), 'yuv420')
 
-    imageCount = 0
-    lastCaptureTime = time.time()  # To track the last capture time
+    gate = CaptureGate(chessboardSize) if useCaptureGate else None
+    pipeline = CapturePipeline(source, chessboardSize, squareSize, outputDir, imageFormat=imageFormat, pngCompression=pngCompression, gate=gate)
+    pipeline.start()
     print("Align the chessboard pattern and the image will be captured automatically.")
 
-    while True:
-        # Capture frame
-        frame = picam2.capture_array()
-
-        # Convert the frame from RGB (if needed) to BGR
-        if frame.shape[2] == 4:
-            # If the frame has 4 channels, assume it's RGBA and convert to BGR
-            frame = cv2.cvtColor(frame, cv2.COLOR_RGBA2BGR)
-        elif frame.shape[2] == 3:
-            # If the frame has 3 channels, assume it's RGB and convert to BGR
-            frame = cv2.cvtColor(frame, cv2.COLOR_RGB2BGR)
-
-        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-        ret, corners = cv2.findChessboardCorners(gray, chessboardSize, None)
+    statsText = ''
+    lastStatsTime = time.monotonic()
+    while pipeline.running.is_set():
+        frame = pipeline.previewQueue.get(timeout=1.0)
+        if frame is None:
+            continue
 
+        # Detection runs behind the preview, so the corners drawn may come from a frame or two earlier
+        ret, corners = pipeline.detection
+        frameCopy = source.toBgr(frame, copy=True)  # Make a copy of the frame for displaying the feedback
         if ret:
-            frameCopy = frame.copy()  # Make a copy of the frame for displaying feedback
             cv2.drawChessboardCorners(frameCopy, chessboardSize, corners, ret)
+        if ret and pipeline.gateStatus is None:
             cv2.putText(frameCopy, 'Ready to Capture', (10, 30), cv2.FONT_HERSHEY_SIMPLEX, 1, (0, 255, 0), 2, cv2.LINE_AA)
+        else:
+            message = gateMessages.get(pipeline.gateStatus, 'Align the Chessboard')
+            cv2.putText(frameCopy, message, (10, 30), cv2.FONT_HERSHEY_SIMPLEX, 1, (0, 0, 255), 2, cv2.LINE_AA)
 
-            currentTime = time.time()
-            if currentTime - lastCaptureTime > 1:  # Check if 1 second has passed since last capture
-                # Capture and save the image
-                imageCount += 1
-                imagePath = os.path.join(outputDir, f'image_{imageCount}.png')
-                cv2.imwrite(imagePath, frame)  # Save the original frame without the added lines or text
-                print(f'Captured {imagePath}')
-                lastCaptureTime = currentTime  # Update last capture time
+        calibrator = pipeline.calibrator
+        if calibrator is not None:
+            cv2.putText(frameCopy, calibrator.status(), (10, 60), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (255, 255, 0), 1, cv2.LINE_AA)
 
-        else:
-            frameCopy = frame.copy()  # Make a copy of the frame for displaying feedback
-            cv2.putText(frameCopy, 'Align the Chessboard', (10, 30), cv2.FONT_HERSHEY_SIMPLEX, 1, (0, 0, 255), 2, cv2.LINE_AA)
+        # Report per-stage throughput and queue depth every few seconds
+        pipeline.counters['preview'].tick()
+        if time.monotonic() - lastStatsTime > 5:
+            statsText = pipeline.stats()
+            print(statsText)
+            lastStatsTime = time.monotonic()
+        cv2.putText(frameCopy, statsText, (10, frameCopy.shape[0] - 10), cv2.FONT_HERSHEY_SIMPLEX, 0.4, (255, 255, 255), 1, cv2.LINE_AA)
 
         cv2.imshow('Calibration Image Capture', frameCopy)
 
@@ -63,7 +279,20 @@ def captureCalibrationImages():
         if key == 27:  # Exit on 'Esc' key
             break
 
-    picam2.stop()
+    # Waits for the writer to finish saving every captured image
+    pipeline.stop()
+
+    # Keep the live estimate next to the images so cameraCalibration.npz in the working directory is never overwritten
+    calibrator = pipeline.calibrator
+    if calibrator is not None:
+        calibrator.update(force=True)
+        calibrator.close()
+        if calibrator.cameraMatrix is not None:
+            calibrationPath = os.path.join(outputDir, 'cameraCalibration.npz')
+            calibrator.save(calibrationPath)
+            print(f'Saved live calibration estimate ({calibrator.status()}) to {calibrationPath}')
+
+    source.close()
     cv2.destroyAllWindows()
 
 captureCalibrationImages()
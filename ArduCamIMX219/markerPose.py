@@ -0,0 +1,457 @@
+import json
+import queue
+import threading
+import time
+import cv2
+import cv2.aruco as aruco
+import numpy as np
+
+# Below this many markers per frame NumPy's per-call overhead outweighs batching, so each marker goes to solvePnP.
+# Measured with benchmarkPoseEstimation, the batched solve breaks even at about 48 (0.8x at 40, 1.0x at 48, 1.3x at 64).
+batchMinMarkers = 48
+
+# One record per detected marker, returned by estimateMarkerPoses. eulerAngles are (yaw, pitch, roll) in degrees, in
+# the same convention as getEulerAngles below.
+poseDtype = np.dtype([
+    ('id', np.int32),
+    ('corners', np.float32, (4, 2)),
+    ('center', np.float64, 2),
+    ('rvec', np.float64, 3),
+    ('tvec', np.float64, 3),
+    ('rotationMatrix', np.float64, (3, 3)),
+    ('eulerAngles', np.float64, 3),
+    ('quaternion', np.float64, 4),
+    ('distance', np.float64),
+])
+
+# A pose stamped with when and where it was seen, camera is an index into the caller's list of cameras
+recordDtype = np.dtype([('timestamp', np.float64), ('camera', np.int16), ('frameIndex', np.int64)] + poseDtype.descr)
+
+# The packed subset of recordDtype that PoseFileSink writes
+outputFields = ('timestamp', 'camera', 'frameIndex', 'id', 'rvec', 'tvec', 'distance', 'eulerAngles')
+outputDtype = np.dtype([(name, recordDtype.fields[name][0]) for name in outputFields])
+
+def markerObjectPoints(markerLength):
+    # Corner order used by detectMarkers and required by SOLVEPNP_IPPE_SQUARE
+    half = markerLength / 2
+    return np.array([[-half, half, 0], [half, half, 0], [half, -half, 0], [-half, -half, 0]])
+
+def squareHomographies(imagePoints, half):
+    # Exact homographies (N x 3 x 3) mapping the square with corners at (+-half, +-half) onto each N x 4 x 2 quad
+    square = markerObjectPoints(2 * half)[:, :2]
+    n = len(imagePoints)
+    A = np.zeros((n, 8, 8))
+    b = imagePoints.reshape(n, 8)
+    for k, (x, y) in enumerate(square):
+        u, v = imagePoints[:, k, 0], imagePoints[:, k, 1]
+        A[:, 2 * k, 0:3] = [x, y, 1]
+        A[:, 2 * k, 6] = -u * x
+        A[:, 2 * k, 7] = -u * y
+        A[:, 2 * k + 1, 3:6] = [x, y, 1]
+        A[:, 2 * k + 1, 6] = -v * x
+        A[:, 2 * k + 1, 7] = -v * y
+    h = np.linalg.solve(A, b[..., None])[..., 0]
+    return np.concatenate([h, np.ones((n, 1))], axis=1).reshape(n, 3, 3)
+
+def ippeRotations(H):
+    # The two rotations IPPE (Collins and Bartoli, 2014) recovers from the homography's Jacobian at the marker center,
+    # computed for every marker at once. Follows OpenCV's PoseSolver::computeRotations.
+    p = H[:, 0, 2] / H[:, 2, 2]
+    q = H[:, 1, 2] / H[:, 2, 2]
+    J = np.empty((len(H), 2, 2))
+    J[:, 0, 0] = H[:, 0, 0] - H[:, 2, 0] * p
+    J[:, 0, 1] = H[:, 0, 1] - H[:, 2, 1] * p
+    J[:, 1, 0] = H[:, 1, 0] - H[:, 2, 0] * q
+    J[:, 1, 1] = H[:, 1, 1] - H[:, 2, 1] * q
+    J /= H[:, 2, 2, None, None]
+
+    # Rv rotates the z axis onto the viewing ray through the marker center
+    ray = np.stack([p, q, np.ones_like(p)], axis=1)
+    ray /= np.linalg.norm(ray, axis=1, keepdims=True)
+    axis = np.stack([-ray[:, 1], ray[:, 0], np.zeros_like(p)], axis=1)
+    s = np.linalg.norm(axis, axis=1)
+    c = ray[:, 2]
+    axis[s > 0] /= s[s > 0, None]
+    K = np.zeros((len(H), 3, 3))
+    K[:, 0, 2], K[:, 1, 2] = axis[:, 1], -axis[:, 0]
+    K[:, 2, 0], K[:, 2, 1] = -axis[:, 1], axis[:, 0]
+    Rv = np.eye(3) + s[:, None, None] * K + (1 - c)[:, None, None] * (K @ K)
+
+    B = Rv[:, :2, :2] - ray[:, :2, None] / ray[:, 2, None, None] * Rv[:, 2:3, :2]
+    A = np.linalg.solve(B, J)
+    gamma = np.linalg.norm(A, ord=2, axis=(1, 2))
+    Rt = A / gamma[:, None, None]
+
+    b0 = np.sqrt(np.clip(1 - Rt[:, 0, 0] ** 2 - Rt[:, 1, 0] ** 2, 0, None))
+    b1 = np.sqrt(np.clip(1 - Rt[:, 0, 1] ** 2 - Rt[:, 1, 1] ** 2, 0, None))
+    b1 = np.where(Rt[:, 0, 0] * Rt[:, 0, 1] + Rt[:, 1, 0] * Rt[:, 1, 1] > 0, -b1, b1)
+
+    rotations = []
+    for sign in (1, -1):
+        first = np.stack([Rt[:, 0, 0], Rt[:, 1, 0], sign * b0], axis=1)
+        second = np.stack([Rt[:, 0, 1], Rt[:, 1, 1], sign * b1], axis=1)
+        rotations.append(Rv @ np.stack([first, second, np.cross(first, second)], axis=2))
+    return rotations
+
+def planarTranslations(R, objectPoints, imagePoints):
+    # Least-squares translations for known rotations, from the two linear equations each normalized image point gives
+    rotated = objectPoints @ R.transpose(0, 2, 1)  # N x 4 x 3
+    u, v = imagePoints[..., 0], imagePoints[..., 1]
+    n = imagePoints.shape[1]
+    AtA = np.zeros((len(R), 3, 3))
+    AtA[:, 0, 0] = AtA[:, 1, 1] = n
+    AtA[:, 0, 2] = AtA[:, 2, 0] = -u.sum(axis=1)
+    AtA[:, 1, 2] = AtA[:, 2, 1] = -v.sum(axis=1)
+    AtA[:, 2, 2] = (u * u + v * v).sum(axis=1)
+    bx = u * rotated[..., 2] - rotated[..., 0]
+    by = v * rotated[..., 2] - rotated[..., 1]
+    Atb = np.stack([bx.sum(axis=1), by.sum(axis=1), -(u * bx + v * by).sum(axis=1)], axis=1)
+    return np.linalg.solve(AtA, Atb[..., None])[..., 0]
+
+def normalizedReprojectionErrors(R, t, objectPoints, imagePoints):
+    cameraPoints = objectPoints @ R.transpose(0, 2, 1) + t[:, None, :]
+    projected = cameraPoints[..., :2] / cameraPoints[..., 2:]
+    return ((projected - imagePoints) ** 2).sum(axis=(1, 2))
+
+def rotationMatricesToVectors(R):
+    # Batched inverse of cv2.Rodrigues. Near 180 degrees the axis comes from the symmetric part of R, where the
+    # antisymmetric part used elsewhere vanishes.
+    skew = 0.5 * np.stack([R[:, 2, 1] - R[:, 1, 2], R[:, 0, 2] - R[:, 2, 0], R[:, 1, 0] - R[:, 0, 1]], axis=1)
+    sinTheta = np.linalg.norm(skew, axis=1)
+    cosTheta = np.clip((np.trace(R, axis1=1, axis2=2) - 1) / 2, -1, 1)
+    theta = np.arctan2(sinTheta, cosTheta)
+
+    scale = np.ones_like(theta)
+    nonZero = sinTheta > 1e-12
+    scale[nonZero] = theta[nonZero] / sinTheta[nonZero]
+    rvecs = skew * scale[:, None]
+
+    obtuse = cosTheta < 0
+    if np.any(obtuse):
+        outer = (0.5 * (R[obtuse] + R[obtuse].transpose(0, 2, 1)) - cosTheta[obtuse, None, None] * np.eye(3)) / (1 - cosTheta[obtuse, None, None])
+        column = np.argmax(np.diagonal(outer, axis1=1, axis2=2), axis=1)
+        axis = outer[np.arange(len(column)), :, column]
+        axis /= np.linalg.norm(axis, axis=1, keepdims=True)
+        axis *= np.where(np.sum(axis * skew[obtuse], axis=1) < 0, -1, 1)[:, None]
+        rvecs[obtuse] = axis * theta[obtuse, None]
+    return rvecs
+
+def rotationVectorsToMatrices(rvecs):
+    # Batched cv2.Rodrigues for N x 3 rotation vectors
+    theta = np.linalg.norm(rvecs, axis=1)
+    small = theta < 1e-12
+    safeTheta = np.where(small, 1, theta)
+    axis = rvecs / safeTheta[:, None]
+    K = np.zeros((len(rvecs), 3, 3))
+    K[:, 0, 1], K[:, 0, 2] = -axis[:, 2], axis[:, 1]
+    K[:, 1, 0], K[:, 1, 2] = axis[:, 2], -axis[:, 0]
+    K[:, 2, 0], K[:, 2, 1] = -axis[:, 1], axis[:, 0]
+    R = np.eye(3) + np.sin(theta)[:, None, None] * K + (1 - np.cos(theta))[:, None, None] * (K @ K)
+    R[small] = np.eye(3)
+    return R
+
+def eulerAnglesFromMatrices(R):
+    # Vectorized getEulerAngles for N x 3 x 3 rotation matrices, the gimbal-lock branch is selected per row with a mask
+    sy = np.sqrt(R[:, 0, 0] ** 2 + R[:, 1, 0] ** 2)
+    singular = sy < 1e-6
+    x = np.where(singular, np.arctan2(-R[:, 1, 2], R[:, 1, 1]), np.arctan2(R[:, 2, 1], R[:, 2, 2]))
+    y = np.arctan2(-R[:, 2, 0], sy)
+    z = np.where(singular, 0, np.arctan2(R[:, 1, 0], R[:, 0, 0]))
+    return np.degrees(np.stack([x, y, z], axis=1))
+
+def quaternionsFromVectors(rvecs):
+    # N x 4 unit quaternions (w, x, y, z) with w >= 0. rvecs longer than pi give a negative w, q and -q are the same
+    # rotation so those rows are negated.
+    theta = np.linalg.norm(rvecs, axis=1)
+    scale = np.full_like(theta, 0.5)  # sin(theta / 2) / theta tends to 1/2 for small angles
+    nonZero = theta > 1e-12
+    scale[nonZero] = np.sin(theta[nonZero] / 2) / theta[nonZero]
+    quaternions = np.column_stack([np.cos(theta / 2), rvecs * scale[:, None]])
+    quaternions[quaternions[:, 0] < 0] *= -1
+    return quaternions
+
+def asRotations(rotations):
+    # Sorts the inputs of getEulerAngles and getQuaternions into (rvecs, matrices, single). Anything ending in 3 x 3
+    # is rotation matrices, anything else is rotation vectors, including the N x 3 x 1 rvecs of calibrateCamera and the
+    # N x 1 x 3 of estimatePoseSingleMarkers. Only a bare (3,) or (3, 1) rvec counts as single.
+    rotations = np.asarray(rotations, dtype=np.float64)
+    if rotations.ndim >= 2 and rotations.shape[-2:] == (3, 3):
+        return None, rotations.reshape(-1, 3, 3), False
+    return rotations.reshape(-1, 3), None, rotations.shape in ((3,), (3, 1))
+
+def getEulerAngles(rotations):
+    # Yaw, pitch and roll in degrees from an N x 3 array of rvecs or N x 3 x 3 rotation matrices, as an N x 3 array.
+    # A single rvec, as the trackers used to pass, still gives a (yaw, pitch, roll) tuple.
+    rvecs, R, single = asRotations(rotations)
+    if R is None:
+        R = rotationVectorsToMatrices(rvecs)
+    angles = eulerAnglesFromMatrices(R)
+    return tuple(angles[0]) if single else angles
+
+def getQuaternions(rotations):
+    # Unit quaternions (w, x, y, z) for the same inputs as getEulerAngles, N x 4 or a single quaternion
+    rvecs, R, single = asRotations(rotations)
+    if rvecs is None:
+        rvecs = rotationMatricesToVectors(R)
+    quaternions = quaternionsFromVectors(rvecs)
+    return quaternions[0] if single else quaternions
+
+def estimateMarkerPoses(markerCorners, markerIds, markerLength, cameraMatrix, distCoeffs, batched=None):
+    # Solves every marker in a frame together: one undistortPoints call for all corners, then IPPE on the whole batch.
+    # Gives the same poses as solvePnP with SOLVEPNP_IPPE_SQUARE run on each marker, which is what small batches use.
+    # batched forces one or the other, by default it depends on batchMinMarkers.
+    poses = np.zeros(0 if markerIds is None else len(markerIds), dtype=poseDtype)
+    if len(poses) == 0:
+        return poses
+
+    corners = np.asarray(markerCorners, dtype=np.float32).reshape(-1, 4, 2)
+    objectPoints = markerObjectPoints(markerLength)
+    if batched is None:
+        batched = len(poses) >= batchMinMarkers
+    if not batched:
+        for pose, imagePoints in zip(poses, corners):
+            _, rvec, tvec = cv2.solvePnP(objectPoints, imagePoints, cameraMatrix, distCoeffs, flags=cv2.SOLVEPNP_IPPE_SQUARE)
+            pose['rvec'] = rvec.ravel()
+            pose['tvec'] = tvec.ravel()
+            pose['rotationMatrix'] = cv2.Rodrigues(rvec)[0]
+    else:
+        normalized = cv2.undistortPoints(corners.reshape(-1, 1, 2), cameraMatrix, distCoeffs).reshape(-1, 4, 2).astype(np.float64)
+
+        # Of the two IPPE solutions keep the one that reprojects best
+        H = squareHomographies(normalized, markerLength / 2)
+        candidates = []
+        for R in ippeRotations(H):
+            t = planarTranslations(R, objectPoints, normalized)
+            candidates.append((R, t, normalizedReprojectionErrors(R, t, objectPoints, normalized)))
+        (R1, t1, error1), (R2, t2, error2) = candidates
+        useFirst = error1 <= error2
+        R = np.where(useFirst[:, None, None], R1, R2)
+        poses['rvec'] = rotationMatricesToVectors(R)
+        poses['tvec'] = np.where(useFirst[:, None], t1, t2)
+        poses['rotationMatrix'] = R
+
+    poses['id'] = np.asarray(markerIds).reshape(-1)
+    poses['corners'] = corners
+    poses['center'] = corners.mean(axis=1)
+    poses['eulerAngles'] = eulerAnglesFromMatrices(poses['rotationMatrix'])
+    poses['quaternion'] = quaternionsFromVectors(poses['rvec'])
+    poses['distance'] = np.linalg.norm(poses['tvec'], axis=1)
+    return poses
+
+def makeRecords(poses, timestamp, frameIndex, camera=0):
+    records = np.zeros(len(poses), dtype=recordDtype)
+    records['timestamp'] = timestamp
+    records['camera'] = camera
+    records['frameIndex'] = frameIndex
+    for name in poseDtype.names:
+        records[name] = poses[name]
+    return records
+
+class PoseSink:
+    # Shared destination for pose records, write() may be called from any thread.
+    # Keeps the records in memory, records() returns everything written so far as one array.
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.chunks = []
+
+    def write(self, records):
+        with self.lock:
+            self.chunks.append(records)
+
+    def records(self):
+        with self.lock:
+            return np.concatenate(self.chunks) if self.chunks else np.zeros(0, dtype=recordDtype)
+
+    def close(self):
+        pass
+
+class PoseFileSink:
+    # Appends pose records to a file through a large write buffer on a background thread, so the tracking loop never
+    # waits on formatting or the disk. 'ndjson' writes one JSON object per marker per line, 'binary' writes packed
+    # outputDtype records that readPoseRecords loads back.
+    def __init__(self, path, outputFormat='ndjson', bufferSize=1 << 20):
+        if outputFormat not in ('ndjson', 'binary'):
+            raise ValueError(f"Unsupported output format '{outputFormat}', use 'ndjson' or 'binary'")
+
+        self.outputFormat = outputFormat
+        self.file = open(path, 'w' if outputFormat == 'ndjson' else 'wb', buffering=bufferSize)
+        self.queue = queue.SimpleQueue()
+        self.error = None
+        self.thread = threading.Thread(target=self.writeLoop, daemon=True)
+        self.thread.start()
+
+    def write(self, records):
+        if len(records):
+            self.queue.put(records)
+
+    def writeLoop(self):
+        while True:
+            records = self.queue.get()
+            if records is None:
+                break
+            if self.error is not None:
+                continue
+
+            output = np.empty(len(records), dtype=outputDtype)
+            for name in outputFields:
+                output[name] = records[name]
+            try:
+                if self.outputFormat == 'binary':
+                    self.file.write(output.tobytes())
+                else:
+                    columns = [output[name].tolist() for name in outputFields]
+                    self.file.writelines(json.dumps(dict(zip(outputFields, record))) + '\n' for record in zip(*columns))
+            except OSError as e:
+                self.error = e
+                print(f'Error: Failed to write pose records: {e}')
+
+    def close(self):
+        # Waits until every record written so far is on disk
+        self.queue.put(None)
+        self.thread.join()
+        self.file.close()
+
+def readPoseRecords(path, outputFormat='ndjson'):
+    # Loads a file written by PoseFileSink back into an outputDtype array, outputFormat must match the one it was written with
+    if outputFormat not in ('ndjson', 'binary'):
+        raise ValueError(f"Unsupported output format '{outputFormat}', use 'ndjson' or 'binary'")
+
+    if outputFormat == 'ndjson':
+        with open(path) as f:
+            rows = [json.loads(line) for line in f]
+        return np.array([tuple(row[name] for name in outputFields) for row in rows], dtype=outputDtype)
+    return np.fromfile(path, dtype=outputDtype)
+
+def syntheticMarkerCorners(numMarkers, markerLength, cameraMatrix, distCoeffs, seed=0):
+    # Projects randomly placed and tilted markers in front of the camera, as a stand-in for a wall full of markers
+    rng = np.random.default_rng(seed)
+    rvecs = np.column_stack([np.pi + rng.uniform(-0.5, 0.5, numMarkers), rng.uniform(-0.5, 0.5, (numMarkers, 2))])
+    tvecs = np.column_stack([rng.uniform(-1, 1, (numMarkers, 2)), rng.uniform(2, 5, numMarkers)])
+    objectPoints = markerObjectPoints(markerLength)
+    corners = [cv2.projectPoints(objectPoints, rvecs[i], tvecs[i], cameraMatrix, distCoeffs)[0].reshape(1, 4, 2).astype(np.float32)
+               for i in range(numMarkers)]
+    return tuple(corners), np.arange(numMarkers).reshape(-1, 1)
+
+def benchmarkPoseEstimation(numMarkers=50, markerLength=0.2, repeats=50):
+    # Compares the per-marker loop the trackers used (estimatePoseSingleMarkers, Rodrigues and the scalar Euler angles)
+    # with both paths of estimateMarkerPoses, and checks the batched poses against solvePnP with SOLVEPNP_IPPE_SQUARE
+    cameraMatrix = np.array([[900.0, 0, 640], [0, 900, 360], [0, 0, 1]])
+    distCoeffs = np.array([[0.05, -0.1, 0.001, -0.001, 0.02]])
+    markerCorners, markerIds = syntheticMarkerCorners(numMarkers, markerLength, cameraMatrix, distCoeffs)
+    objectPoints = markerObjectPoints(markerLength)
+
+    def perMarkerLoop():
+        for i in range(len(markerIds)):
+            rvec, tvec, _ = aruco.estimatePoseSingleMarkers(markerCorners[i], markerLength, cameraMatrix, distCoeffs)
+            rotationMatrix, _ = cv2.Rodrigues(rvec[0])
+            sy = np.sqrt(rotationMatrix[0, 0] * rotationMatrix[0, 0] + rotationMatrix[1, 0] * rotationMatrix[1, 0])
+            np.degrees(np.arctan2(rotationMatrix[2, 1], rotationMatrix[2, 2]))
+            np.degrees(np.arctan2(-rotationMatrix[2, 0], sy))
+            np.degrees(np.arctan2(rotationMatrix[1, 0], rotationMatrix[0, 0]))
+            np.linalg.norm(tvec)
+
+    timings = []
+    for estimate in (perMarkerLoop,
+                     lambda: estimateMarkerPoses(markerCorners, markerIds, markerLength, cameraMatrix, distCoeffs, batched=False),
+                     lambda: estimateMarkerPoses(markerCorners, markerIds, markerLength, cameraMatrix, distCoeffs, batched=True)):
+        start = time.perf_counter()
+        for _ in range(repeats):
+            estimate()
+        timings.append((time.perf_counter() - start) / repeats * 1000)
+
+    poses = estimateMarkerPoses(markerCorners, markerIds, markerLength, cameraMatrix, distCoeffs, batched=True)
+    rotationDifference = translationDifference = 0
+    for pose, corners in zip(poses, markerCorners):
+        _, rvec, tvec = cv2.solvePnP(objectPoints, corners, cameraMatrix, distCoeffs, flags=cv2.SOLVEPNP_IPPE_SQUARE)
+        rotationDifference = max(rotationDifference, np.abs(cv2.Rodrigues(rvec)[0] - pose['rotationMatrix']).max(),
+                                 np.abs(cv2.Rodrigues(pose['rvec'])[0] - pose['rotationMatrix']).max())
+        translationDifference = max(translationDifference, np.abs(tvec.ravel() - pose['tvec']).max())
+
+    print(f'{numMarkers} markers: per-marker loop {timings[0]:.2f} ms, estimateMarkerPoses with solvePnP {timings[1]:.2f} ms, '
+          f'batched {timings[2]:.2f} ms ({timings[1] / timings[2]:.1f}x), largest difference to SOLVEPNP_IPPE_SQUARE: '
+          f'rotation matrix {rotationDifference:.1e}, translation {translationDifference:.1e} m')
+
+def checkEulerAngles(numSamples=1000000, seed=0, tolerance=1e-9):
+    # Compares getEulerAngles against the scalar version the trackers used to have, on random rotations (some longer
+    # than pi) plus some exactly at gimbal lock, checks the rvec shapes OpenCV returns and that the quaternions rotate
+    # vectors the same way the matrices do. Raises AssertionError when any difference exceeds tolerance.
+    def scalarEulerAngles(rvec):
+        rotationMatrix, _ = cv2.Rodrigues(rvec)
+        sy = np.sqrt(rotationMatrix[0, 0] * rotationMatrix[0, 0] + rotationMatrix[1, 0] * rotationMatrix[1, 0])
+
+        singular = sy < 1e-6
+
+        if not singular:
+            x = np.arctan2(rotationMatrix[2, 1], rotationMatrix[2, 2])
+            y = np.arctan2(-rotationMatrix[2, 0], sy)
+            z = np.arctan2(rotationMatrix[1, 0], rotationMatrix[0, 0])
+        else:
+            x = np.arctan2(-rotationMatrix[1, 2], rotationMatrix[1, 1])
+            y = np.arctan2(-rotationMatrix[2, 0], sy)
+            z = 0
+
+        return np.degrees(x), np.degrees(y), np.degrees(z)
+
+    def angleDifference(a, b):
+        # Angles either side of +-180 degrees are the same angle
+        return np.abs((np.asarray(a) - b + 180) % 360 - 180).max()
+
+    rng = np.random.default_rng(seed)
+    rvecs = rng.normal(size=(numSamples, 3))
+    rvecs *= (rng.uniform(0, 2 * np.pi, numSamples) / np.linalg.norm(rvecs, axis=1))[:, None]
+    gimbalLock = rotationMatricesToVectors(np.array([cv2.Rodrigues(np.array([0.0, sign * np.pi / 2, 0]))[0] @ cv2.Rodrigues(np.array([angle, 0, 0]))[0]
+                                                    for sign in (1, -1) for angle in np.linspace(-3, 3, 13)]))
+    rvecs[:len(gimbalLock)] = gimbalLock
+    rvecs[len(gimbalLock)] = 0
+
+    numScalar = min(numSamples, 20000)
+    start = time.perf_counter()
+    expected = np.array([scalarEulerAngles(rvec) for rvec in rvecs[:numScalar]])
+    scalarTime = (time.perf_counter() - start) / numScalar * numSamples
+
+    start = time.perf_counter()
+    angles = getEulerAngles(rvecs)
+    vectorTime = time.perf_counter() - start
+    quaternions = getQuaternions(rvecs)
+
+    differences = {
+        'scalar version': angleDifference(angles[:numScalar], expected),
+        'matrix input': angleDifference(getEulerAngles(rotationVectorsToMatrices(rvecs[:numScalar])), angles[:numScalar]),
+    }
+
+    # The shapes rvecs arrive in: a bare rvec, calibrateCamera's N x 3 x 1, estimatePoseSingleMarkers' N x 1 x 3 and a
+    # 1 x 3 row. Only the first two give a tuple, everything else an N x 3 array.
+    single = getEulerAngles(rvecs[1])
+    assert isinstance(single, tuple) and isinstance(getEulerAngles(rvecs[1].reshape(3, 1)), tuple)
+    differences['single rvec'] = angleDifference(single, expected[1])
+    for shape in ((-1, 3, 1), (-1, 1, 3)):
+        shaped = getEulerAngles(rvecs[:numScalar].reshape(shape))
+        assert shaped.shape == (numScalar, 3), shape
+        differences[f'{shape[1]} x {shape[2]} rvecs'] = angleDifference(shaped, expected)
+    row = getEulerAngles(rvecs[1:2])
+    assert isinstance(row, np.ndarray) and row.shape == (1, 3)
+    assert getQuaternions(rvecs[1:2]).shape == (1, 4) and getQuaternions(rvecs[1]).shape == (4,)
+
+    # q v q* written out for unit quaternions: v + 2w (u x v) + 2 u x (u x v)
+    vectors = rng.normal(size=(numSamples, 3))
+    w, u = quaternions[:, :1], quaternions[:, 1:]
+    uv = np.cross(u, vectors)
+    rotated = vectors + 2 * w * uv + 2 * np.cross(u, uv)
+    differences['quaternion rotation'] = np.abs(rotated - (rotationVectorsToMatrices(rvecs) @ vectors[..., None])[..., 0]).max()
+    differences['quaternion norm'] = np.abs(np.linalg.norm(quaternions, axis=1) - 1).max()
+    # Matrices lose the difference between q and -q, with w >= 0 both routes must agree except where w is 0
+    fromMatrices = getQuaternions(rotationVectorsToMatrices(rvecs))
+    differences['quaternions from matrices'] = np.abs(np.abs(fromMatrices) - np.abs(quaternions)).max()
+    assert quaternions[:, 0].min() >= 0 and fromMatrices[:, 0].min() >= 0
+    assert getQuaternions([0, 0, 4])[0] > 0
+
+    print(f'{numSamples} rotations: scalar getEulerAngles {scalarTime:.2f} s (extrapolated from {numScalar}), '
+          f'vectorized {vectorTime:.3f} s ({scalarTime / vectorTime:.0f}x), {len(gimbalLock)} at gimbal lock')
+    print('Largest differences: ' + ', '.join(f'{name} {difference:.1e}' for name, difference in differences.items()))
+    for name, difference in differences.items():
+        assert difference < tolerance, f'{name} differs by {difference:.1e}'
+
+if __name__ == "__main__":
+    checkEulerAngles()
+    for numMarkers in (1, 4, 8, 16, 32, 48, 64, 200):
+        benchmarkPoseEstimation(numMarkers)
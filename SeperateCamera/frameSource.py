@@ -0,0 +1,548 @@
+import os
+import glob
+import threading
+import time
+import cv2
+import cv2.aruco as aruco
+import numpy as np
+
+try:
+    import requests
+except ImportError:  # Only HttpFrameSource needs it
+    requests = None
+
+# Every source delivers frames in one of these: 'bgr' (H x W x 3, what OpenCV draws and saves) or 'gray' (H x W, all
+# that detection needs). Sources produce the requested one as directly as the camera allows instead of converting later.
+# PicameraFrameSource also has 'yuv420', the camera's own I420 buffer, which is gray for free and BGR on request.
+pixelFormats = ('bgr', 'gray', 'yuv420')
+imageExtensions = ('.png', '.jpg', '.jpeg', '.bmp', '.tif', '.tiff', '.webp', '.npy')
+cornerSidecarSuffix = '.corners.npy'  # Corners the capture scripts save next to each image, never a frame themselves
+
+# imdecode flags for each scale factor libjpeg can apply in the DCT domain while decoding, as (color, grayscale)
+reducedDecodeFlags = {
+    1: (cv2.IMREAD_COLOR, cv2.IMREAD_GRAYSCALE),
+    2: (cv2.IMREAD_REDUCED_COLOR_2, cv2.IMREAD_REDUCED_GRAYSCALE_2),
+    4: (cv2.IMREAD_REDUCED_COLOR_4, cv2.IMREAD_REDUCED_GRAYSCALE_4),
+    8: (cv2.IMREAD_REDUCED_COLOR_8, cv2.IMREAD_REDUCED_GRAYSCALE_8),
+}
+
+def jpegSize(data):
+    # Reads (width, height) from the JPEG frame header without decoding any pixels
+    i = 2
+    while i + 9 < len(data):
+        if data[i] != 0xFF:
+            return None
+        marker = data[i + 1]
+        if marker == 0xFF:  # Fill byte
+            i += 1
+            continue
+
+        # Every start-of-frame marker except DHT (C4), JPG (C8) and DAC (CC) carries the image size
+        if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+            return (data[i + 7] << 8) | data[i + 8], (data[i + 5] << 8) | data[i + 6]
+        i += 2 + ((data[i + 2] << 8) | data[i + 3])
+    return None
+
+def decodeJpeg(data, targetWidth=None, grayscale=False):
+    # With a targetWidth, libjpeg scales by 1/2, 1/4 or 1/8 while decoding to the smallest size that is still at least
+    # that wide, so most of the pixels that would be thrown away by the resize are never decoded in the first place
+    factor = 1
+    if targetWidth is not None:
+        size = jpegSize(data)
+        if size is not None:
+            while factor < 8 and size[0] // (factor * 2) >= targetWidth:
+                factor *= 2
+
+    img = cv2.imdecode(np.frombuffer(data, np.uint8), reducedDecodeFlags[factor][grayscale])
+    if img is None or targetWidth is None or img.shape[1] == targetWidth:
+        return img
+
+    # Same sizing as imutils.resize(img, width=targetWidth)
+    h, w = img.shape[:2]
+    return cv2.resize(img, (targetWidth, int(h * targetWidth / w)), interpolation=cv2.INTER_AREA)
+
+class FrameSource:
+    # Common interface of every source: read() returns the next frame in self.pixelFormat, or None once the source
+    # has ended or failed. Sources can also be iterated over and used in a with statement.
+    # toGray() and toBgr() turn a frame into what detection or drawing needs, converting only if it isn't already.
+    def __init__(self, pixelFormat='bgr', supportedFormats=('bgr', 'gray')):
+        if pixelFormat not in supportedFormats:
+            raise ValueError(f"Unsupported pixel format '{pixelFormat}', use one of {', '.join(supportedFormats)}")
+        self.pixelFormat = pixelFormat
+
+    def read(self):
+        raise NotImplementedError
+
+    def toGray(self, frame):
+        if self.pixelFormat == 'gray':
+            return frame
+        return cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+
+    def toBgr(self, frame, copy=False):
+        # copy=True always returns a new array, e.g. to draw on without touching the frame itself
+        if self.pixelFormat == 'bgr':
+            return frame.copy() if copy else frame
+        return cv2.cvtColor(frame, cv2.COLOR_GRAY2BGR)
+
+    def close(self):
+        pass
+
+    def __iter__(self):
+        while True:
+            frame = self.read()
+            if frame is None:
+                return
+            yield frame
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+class VideoFrameSource(FrameSource):
+    # A cv2.VideoCapture: a webcam index, a video file or a stream URL. With reuseBuffers every frame is read (and
+    # converted to gray) into the previous frame's array, which saves an allocation per frame but means a frame is
+    # only valid until the next read(), so only use it when each frame is done with before the next one is read.
+    def __init__(self, source=0, pixelFormat='bgr', size=None, reuseBuffers=False):
+        super().__init__(pixelFormat)
+        self.source = source
+        self.capture = cv2.VideoCapture(source)
+        if not self.capture.isOpened():
+            raise OSError(f'Could not open video capture {source!r}')
+        if size is not None:
+            self.capture.set(cv2.CAP_PROP_FRAME_WIDTH, size[0])
+            self.capture.set(cv2.CAP_PROP_FRAME_HEIGHT, size[1])
+        self.reuseBuffers = reuseBuffers
+        self.frame = None
+        self.gray = None
+
+    def read(self):
+        ret, frame = self.capture.read(self.frame if self.reuseBuffers else None)
+        if not ret:
+            return None
+        if self.reuseBuffers:
+            self.frame = frame
+        if self.pixelFormat == 'bgr':
+            return frame
+
+        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY, dst=self.gray if self.reuseBuffers else None)
+        if self.reuseBuffers:
+            self.gray = gray
+        return gray
+
+    def close(self):
+        self.capture.release()
+
+class PicameraFrameSource(FrameSource):
+    # A Raspberry Pi camera through Picamera2, configured to deliver the requested format itself. Picamera2's RGB888
+    # is stored in BGR order, exactly what OpenCV expects, and YUV420 starts with the full resolution Y plane, which is
+    # the grayscale image, so neither format needs a cvtColor. Gray frames are views into the captured buffer.
+    # With 'yuv420' read() returns the whole buffer: toGray() is the Y plane view and toBgr() converts, so a loop that
+    # detects on every frame but only shows or saves some of them only pays for the color conversion on those.
+    # camera replaces Picamera2() for testing, e.g. with a Picamera2StandIn.
+    def __init__(self, size=(800, 600), pixelFormat='bgr', camera=None):
+        super().__init__(pixelFormat, pixelFormats)
+        if camera is None:
+            from picamera2 import Picamera2  # Only available on a Raspberry Pi
+            camera = Picamera2()
+
+        self.size = size
+        self.picam2 = camera
+        cameraFormat = 'RGB888' if pixelFormat == 'bgr' else 'YUV420'
+        self.picam2.configure(self.picam2.create_preview_configuration(main={"size": size, "format": cameraFormat}))
+        self.picam2.start()
+
+    def read(self):
+        frame = self.picam2.capture_array()
+        if frame is None or frame.size == 0:
+            print("Error: Captured an empty frame.")
+            return None
+        if self.pixelFormat == 'gray':
+            return self.yPlane(frame)
+        return frame
+
+    def yPlane(self, frame):
+        # Rows can be padded beyond the image width to the camera's stride
+        width, height = self.size
+        return frame[:height, :width]
+
+    def toGray(self, frame):
+        if self.pixelFormat == 'yuv420':
+            return self.yPlane(frame)
+        return super().toGray(frame)
+
+    def toBgr(self, frame, copy=False):
+        if self.pixelFormat != 'yuv420':
+            return super().toBgr(frame, copy)
+        # The U and V planes follow with half the stride, so the padded buffer converts as one wider image
+        bgr = cv2.cvtColor(frame, cv2.COLOR_YUV2BGR_I420)
+        return bgr if bgr.shape[1] == self.size[0] else bgr[:, :self.size[0]]
+
+    def close(self):
+        self.picam2.stop()
+        self.picam2.close()
+
+class Picamera2StandIn:
+    # Just enough of Picamera2 to run PicameraFrameSource on any machine: capture_array() copies a synthetic scene
+    # out of a buffer in the configured format, like Picamera2 copies out of the camera's buffers, so only the
+    # conversions are measured rather than the sensor. XBGR8888 (the default, RGBA in memory), RGB888 and YUV420.
+    def __init__(self, scene=None):
+        self.scene = scene
+        self.buffer = None
+
+    def create_preview_configuration(self, main):
+        return {"main": dict({"format": "XBGR8888"}, **main)}
+
+    def configure(self, config):
+        width, height = config["main"]["size"]
+        cameraFormat = config["main"]["format"]
+        scene = self.scene
+        if scene is None:
+            scene = SyntheticFrameSource(1, (width, height)).read()
+        scene = cv2.resize(scene, (width, height))
+        if cameraFormat == 'XBGR8888':
+            self.buffer = cv2.cvtColor(scene, cv2.COLOR_BGR2RGBA)
+        elif cameraFormat == 'RGB888':
+            self.buffer = scene.copy()
+        elif cameraFormat == 'YUV420':
+            self.buffer = cv2.cvtColor(scene, cv2.COLOR_BGR2YUV_I420)
+        else:
+            raise ValueError(f'Picamera2StandIn does not support {cameraFormat}')
+
+    def start(self):
+        pass
+
+    def capture_array(self):
+        return self.buffer.copy()
+
+    def stop(self):
+        pass
+
+    def close(self):
+        pass
+
+def listImages(directory, extensions=imageExtensions):
+    # The images in a directory in name order, without the corner sidecars saved next to them. Every script that reads
+    # a capture directory lists it here, so they all agree on what counts as an image.
+    return sorted(fname for fname in glob.glob(os.path.join(directory, '*'))
+                  if fname.lower().endswith(extensions) and not fname.endswith(cornerSidecarSuffix))
+
+def loadImageArray(fname):
+    # Loads a raw .npy capture, the BGR or gray array exactly as it came from the camera. Returns None for files that
+    # can't be read or don't hold an image, so one bad file doesn't stop whatever is reading the directory.
+    try:
+        image = np.load(fname)
+    except (OSError, ValueError):
+        return None
+    if image.dtype != np.uint8 or not (image.ndim == 2 or (image.ndim == 3 and image.shape[2] in (3, 4))):
+        return None
+    return image[..., :3] if image.ndim == 3 else image
+
+class DirectoryFrameSource(FrameSource):
+    # The images of a directory in name order, such as a calibration capture, decoded straight to the pixel format
+    def __init__(self, directory, pixelFormat='bgr', loop=False):
+        super().__init__(pixelFormat)
+        self.directory = directory
+        self.files = listImages(directory)
+        self.loop = loop
+        self.index = 0
+
+    def read(self):
+        while self.files and (self.loop or self.index < len(self.files)):
+            fname = self.files[self.index % len(self.files)]
+            self.index += 1
+            if fname.lower().endswith('.npy'):
+                frame = loadImageArray(fname)
+                if frame is not None and frame.ndim == 3 and self.pixelFormat == 'gray':
+                    frame = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+                elif frame is not None and frame.ndim == 2 and self.pixelFormat == 'bgr':
+                    frame = cv2.cvtColor(frame, cv2.COLOR_GRAY2BGR)
+            else:
+                frame = cv2.imread(fname, cv2.IMREAD_COLOR if self.pixelFormat == 'bgr' else cv2.IMREAD_GRAYSCALE)
+            if frame is not None:
+                return frame
+            print(f'Warning: Could not read {fname}')
+        return None
+
+class SyntheticFrameSource(FrameSource):
+    # Stands in for a live camera without any hardware: ArUco markers drifting over a textured background
+    def __init__(self, numFrames=300, frameSize=(1280, 720), markerIds=(3, 9, 17), seed=0, pixelFormat='bgr'):
+        super().__init__(pixelFormat)
+        rng = np.random.default_rng(seed)
+        self.numFrames = numFrames
+        self.frameSize = frameSize
+        width, height = frameSize
+        self.background = cv2.GaussianBlur(rng.integers(60, 200, (height, width), dtype=np.uint8), (0, 0), 2)
+        if pixelFormat == 'bgr':
+            self.background = cv2.cvtColor(self.background, cv2.COLOR_GRAY2BGR)
+        side = width // 10
+        border = side // 6  # White quiet zone around each marker
+        arucoDict = aruco.getPredefinedDictionary(aruco.DICT_6X6_250)
+        self.markers = [cv2.copyMakeBorder(aruco.generateImageMarker(arucoDict, markerId, side), border, border, border,
+                                           border, cv2.BORDER_CONSTANT, value=255) for markerId in markerIds]
+        self.phases = rng.uniform(0, 2 * np.pi, len(self.markers))
+        self.frameIndex = 0
+
+    def read(self):
+        if self.frameIndex >= self.numFrames:
+            return None
+        width, height = self.frameSize
+        frame = self.background.copy()
+        for k, (marker, phase) in enumerate(zip(self.markers, self.phases)):
+            x = int(width * (0.1 + 0.8 * k / len(self.markers)) + 40 * np.sin(self.frameIndex / 10 + phase))
+            y = int(height * 0.4 + 30 * np.cos(self.frameIndex / 13 + phase))
+            frame[y:y + marker.shape[0], x:x + marker.shape[1]] = marker if frame.ndim == 2 else marker[..., None]
+        self.frameIndex += 1
+        return frame
+
+class HttpFrameSource(FrameSource):
+    # Reads frames from the IP Webcam app over one persistent connection. A background thread fetches and decodes
+    # the next frame while the caller is still working on the current one.
+    # Works with both the single image endpoint (/shot.jpg) and the MJPEG stream (/video).
+    # Frames come out targetWidth wide when it is set, and gray frames are decoded straight from the JPEG.
+    def __init__(self, url, timeout=5.0, targetWidth=None, pixelFormat='bgr'):
+        super().__init__(pixelFormat)
+        if requests is None:
+            raise ImportError('HttpFrameSource needs the requests package, install it with pip install requests')
+        self.url = url
+        self.timeout = timeout
+        self.targetWidth = targetWidth
+        self.grayscale = pixelFormat == 'gray'
+        self.isStream = url.rstrip('/').endswith('/video')
+        self.session = requests.Session()
+
+        self.condition = threading.Condition()
+        self.frame = None
+        self.error = None
+        self.running = True
+        self.thread = threading.Thread(target=self.streamLoop if self.isStream else self.shotLoop, daemon=True)
+        self.thread.start()
+
+    def decode(self, buffer, start=0, end=None):
+        # Decode straight out of the response buffer without copying it into a new array first
+        return decodeJpeg(memoryview(buffer)[start:end], self.targetWidth, self.grayscale)
+
+    def publish(self, frame=None, error=None):
+        with self.condition:
+            self.frame = frame
+            self.error = error
+            self.condition.notify_all()
+
+    def shotLoop(self):
+        # Fetch one frame ahead, then wait until the caller has taken it before fetching the next one
+        while self.running:
+            try:
+                response = self.session.get(self.url, timeout=self.timeout)
+                response.raise_for_status()
+                frame = self.decode(response.content)
+            except requests.RequestException as e:
+                self.publish(error=e)
+                return
+
+            with self.condition:
+                self.condition.wait_for(lambda: self.frame is None or not self.running)
+            self.publish(frame)
+
+    def streamLoop(self):
+        # The MJPEG stream is pushed at the camera's own rate, so only the newest frame is kept
+        try:
+            with self.session.get(self.url, timeout=self.timeout, stream=True) as response:
+                response.raise_for_status()
+                buffer = bytearray()
+                for chunk in response.iter_content(chunk_size=65536):
+                    if not self.running:
+                        return
+                    buffer += chunk
+
+                    # Every part of the multipart stream is a complete JPEG from its SOI to its EOI marker
+                    while True:
+                        start = buffer.find(b'\xff\xd8')
+                        end = buffer.find(b'\xff\xd9', start + 2) if start >= 0 else -1
+                        if end < 0:
+                            break
+                        frame = self.decode(buffer, start, end + 2)
+                        del buffer[:end + 2]
+                        if frame is not None:
+                            self.publish(frame)
+        except requests.RequestException as e:
+            self.publish(error=e)
+            return
+        self.publish(error=EOFError('The MJPEG stream ended'))
+
+    def read(self):
+        # Returns the next decoded frame, or None once the camera can no longer be reached
+        with self.condition:
+            self.condition.wait_for(lambda: self.frame is not None or self.error is not None)
+            frame, self.frame = self.frame, None
+            self.condition.notify_all()
+        if frame is None:
+            print(f"Error: Failed to read frame from {self.url}: {self.error}")
+        return frame
+
+    def close(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
+        self.thread.join(self.timeout)
+        self.session.close()
+
+def openFrameSource(source, pixelFormat='bgr', **options):
+    # Picks the source for a camera setting: a webcam index, 'picamera', 'synthetic', an IP Webcam URL (ending in
+    # /shot.jpg or /video), an image directory, or a video file or other stream URL. options go to the source's class.
+    if isinstance(source, FrameSource):
+        return source
+    if isinstance(source, int):
+        return VideoFrameSource(source, pixelFormat, **options)
+    if source == 'picamera':
+        return PicameraFrameSource(pixelFormat=pixelFormat, **options)
+    if source == 'synthetic':
+        return SyntheticFrameSource(pixelFormat=pixelFormat, **options)
+    if source.startswith(('http://', 'https://')) and source.rstrip('/').endswith(('.jpg', '/video')):
+        return HttpFrameSource(source, pixelFormat=pixelFormat, **options)
+    if os.path.isdir(source):
+        return DirectoryFrameSource(source, pixelFormat, **options)
+    return VideoFrameSource(source, pixelFormat, **options)
+
+def benchmarkFrameSource(url, numFrames=100, processingTime=0.02):
+    # Compares a new requests.get per frame (the old approach) against HttpFrameSource on /shot.jpg and /video.
+    # processingTime stands in for the detection work each script does on a frame.
+    start = time.perf_counter()
+    for _ in range(numFrames):
+        imgResp = requests.get(url)
+        imgArr = np.array(bytearray(imgResp.content), dtype=np.uint8)
+        cv2.imdecode(imgArr, -1)
+        time.sleep(processingTime)
+    oldFps = numFrames / (time.perf_counter() - start)
+    print(f'requests.get per frame: {oldFps:.1f} FPS')
+
+    for sourceUrl in (url, url.rsplit('/', 1)[0] + '/video'):
+        with HttpFrameSource(sourceUrl) as source:
+            start = time.perf_counter()
+            for _ in range(numFrames):
+                if source.read() is None:
+                    return
+                time.sleep(processingTime)
+            fps = numFrames / (time.perf_counter() - start)
+        print(f'HttpFrameSource on {sourceUrl}: {fps:.1f} FPS ({fps / oldFps:.1f}x)')
+
+def benchmarkDecode(jpeg, targetWidth=1000, repeats=20):
+    # Compares the old full-size decode followed by a resize against decodeJpeg, in color and grayscale
+    def timeDecode(decode):
+        start = time.perf_counter()
+        for _ in range(repeats):
+            img = decode()
+        return (time.perf_counter() - start) / repeats * 1000, img
+
+    def decodeThenResize():
+        img = cv2.imdecode(np.array(bytearray(jpeg), dtype=np.uint8), -1)
+        h, w = img.shape[:2]
+        return cv2.resize(img, (targetWidth, int(h * targetWidth / w)), interpolation=cv2.INTER_AREA)
+
+    oldTime, oldImg = timeDecode(decodeThenResize)
+    newTime, newImg = timeDecode(lambda: decodeJpeg(jpeg, targetWidth))
+    grayTime, _ = timeDecode(lambda: decodeJpeg(jpeg, targetWidth, grayscale=True))
+    difference = np.mean(np.abs(oldImg.astype(np.float32) - newImg))
+
+    print(f'{jpegSize(jpeg)} JPEG to width {targetWidth}: decode+resize {oldTime:.1f} ms, '
+          f'reduced decode {newTime:.1f} ms ({oldTime / newTime:.1f}x, mean abs difference {difference:.2f}), '
+          f'reduced grayscale decode {grayTime:.1f} ms ({oldTime / grayTime:.1f}x)')
+
+def benchmarkPicameraFormats(size=(800, 600), numFrames=200, displayEveryN=5):
+    # Per-frame cost of getting a detection image (and sometimes a displayed one) out of a Picamera2 stream: the old
+    # XBGR8888 capture converted to BGR and then to gray, RGB888 converted to gray, and YUV420 sliced to its Y plane,
+    # converting to BGR only every displayEveryN-th frame. ArUco detection on the same image is timed for scale.
+    camera = Picamera2StandIn()
+    camera.configure(camera.create_preview_configuration({"size": size}))
+    pipelines = {}
+    start = time.perf_counter()
+    for _ in range(numFrames):
+        frame = cv2.cvtColor(camera.capture_array(), cv2.COLOR_RGBA2BGR)
+        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+    pipelines['XBGR8888 -> BGR -> gray'] = (time.perf_counter() - start) / numFrames * 1000
+    reference = gray
+
+    for pixelFormat, name, convertEvery in (('bgr', 'RGB888 -> gray', None), ('yuv420', 'YUV420 Y plane', None),
+                                            ('yuv420', f'YUV420 Y plane + BGR every {displayEveryN}', displayEveryN)):
+        source = PicameraFrameSource(size, pixelFormat, Picamera2StandIn())
+        start = time.perf_counter()
+        for index in range(numFrames):
+            frame = source.read()
+            gray = source.toGray(frame)
+            if convertEvery is not None and index % convertEvery == 0:
+                source.toBgr(frame)
+        pipelines[name] = (time.perf_counter() - start) / numFrames * 1000
+        source.close()
+
+    detector = aruco.ArucoDetector(aruco.getPredefinedDictionary(aruco.DICT_6X6_250), aruco.DetectorParameters())
+    start = time.perf_counter()
+    for _ in range(numFrames // 4):
+        detector.detectMarkers(reference)
+    detectTime = (time.perf_counter() - start) / (numFrames // 4) * 1000
+
+    difference = np.abs(reference.astype(np.int16) - gray).mean()
+    oldTime = pipelines['XBGR8888 -> BGR -> gray']
+    print(f'{size[0]}x{size[1]} frames, ArUco detection takes {detectTime:.2f} ms:')
+    for name, elapsed in pipelines.items():
+        print(f'  {name}: {elapsed:.3f} ms per frame ({oldTime / elapsed:.1f}x)')
+    # The stand-in's Y plane is BT.601 limited range, so it is a few levels off BGR2GRAY, which detection doesn't mind
+    print(f'  Y plane vs converted gray: mean abs difference {difference:.2f}')
+
+def serveTestFrames(frame, port=0, latency=0.0, connectLatency=0.0):
+    # Local stand-in for the IP Webcam app that serves the same JPEG from /shot.jpg and as an MJPEG stream on /video.
+    # latency is added to every frame and connectLatency to every new connection, like the handshakes over Wi-Fi.
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    jpeg = cv2.imencode('.jpg', frame)[1].tobytes()
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'  # Needed for keep-alive
+
+        def setup(self):
+            time.sleep(connectLatency)
+            super().setup()
+
+        def do_GET(self):
+            time.sleep(latency)
+            if self.path == '/video':
+                self.send_response(200)
+                self.send_header('Content-Type', 'multipart/x-mixed-replace; boundary=frame')
+                self.end_headers()
+                try:
+                    while True:
+                        self.wfile.write(b'--frame\r\nContent-Type: image/jpeg\r\nContent-Length: %d\r\n\r\n' % len(jpeg))
+                        self.wfile.write(jpeg + b'\r\n')
+                        time.sleep(latency)
+                except (BrokenPipeError, ConnectionResetError):
+                    return
+            else:
+                self.send_response(200)
+                self.send_header('Content-Type', 'image/jpeg')
+                self.send_header('Content-Length', str(len(jpeg)))
+                self.end_headers()
+                self.wfile.write(jpeg)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+if __name__ == "__main__":
+    for size in ((800, 600), (1640, 1232)):
+        benchmarkPicameraFormats(size)
+
+    url = None  # Replace with your URL, e.g. "http://192.168.1.175:8080/shot.jpg", to benchmark against a real phone
+
+    # A 12MP still like the ones phone cameras produce
+    testFrame = cv2.GaussianBlur(np.random.default_rng(0).integers(0, 256, (3000, 4000, 3), dtype=np.uint8), (0, 0), 3)
+    benchmarkDecode(cv2.imencode('.jpg', testFrame)[1].tobytes())
+
+    if url is None:
+        # Without a phone, benchmark against a local stand-in with Wi-Fi-like latencies
+        server = serveTestFrames(cv2.resize(testFrame, (1920, 1440)), latency=0.01, connectLatency=0.03)
+        url = f'http://127.0.0.1:{server.server_address[1]}/shot.jpg'
+
+    benchmarkFrameSource(url)
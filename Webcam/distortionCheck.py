@@ -1,19 +1,16 @@
-import numpy as np
 import cv2
 import glob
+from calibrationStore import getCalibration
+from undistortion import getUndistortionMaps
 
-def displayImagesWithPause(images, cameraMatrix, distCoeffs):
+def displayImagesWithPause(images, cameraMatrix, distCoeffs, calibrationPath=None):
     for fname in images:
         img = cv2.imread(fname)
         h, w = img.shape[:2]
-        newCameraMtx, roi = cv2.getOptimalNewCameraMatrix(cameraMatrix, distCoeffs, (w, h), 1, (w, h))
 
-        # Undistort
-        dst = cv2.undistort(img, cameraMatrix, distCoeffs, None, newCameraMtx)
-
-        # Crop the image
-        x, y, w, h = roi
-        dst = dst[y:y+h, x:x+w]
+        # Undistort and crop, the maps are only built once for all images of the same size
+        maps = getUndistortionMaps(cameraMatrix, distCoeffs, (w, h), 1, calibrationPath)
+        dst = maps.apply(img)
 
         # Resize the images to ensure they have the same height
         imgResized = cv2.resize(img, (dst.shape[1], dst.shape[0]))
@@ -34,8 +31,10 @@ if __name__ == "__main__":
     images = glob.glob('WRITE YOUR IMAGE DIRECTORY')  # Change path to your image directory
 
     # Load the calibration data
-    with np.load('cameraCalibration.npz') as data:
-        cameraMatrix = data['cameraMatrix']
-        distCoeffs = data['distCoeffs']
+    calibrationPath = 'cameraCalibration.npz'
+    cacheMapsOnDisk = False  # Set to True to keep the undistortion maps in undistortionMaps/ next to the calibration file
+    calibration = getCalibration(calibrationPath)
+    cameraMatrix = calibration.cameraMatrix
+    distCoeffs = calibration.distCoeffs
 
-    displayImagesWithPause(images, cameraMatrix, distCoeffs)
+    displayImagesWithPause(images, cameraMatrix, distCoeffs, calibrationPath if cacheMapsOnDisk else None)
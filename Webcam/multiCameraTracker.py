@@ -0,0 +1,183 @@
+import os
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from calibrationStore import getCalibration
+from frameSource import FrameSource, SyntheticFrameSource, openFrameSource
+from markerPose import PoseFileSink, PoseSink, makeRecords
+from webcamArucoTracker import ArucoTracker
+
+class CameraStream:
+    # One camera with its own calibration and ArucoTracker. source is anything openFrameSource takes (a webcam index,
+    # 'picamera', an Android phone's http://.../video, a video file, an image directory, ...), a FrameSource, or a
+    # function returning frames and None once it runs out.
+    # Live cameras are read on their own thread and only the newest frame is kept, so a busy pool never falls behind.
+    # Recordings and frame functions are read by the worker itself, so every frame gets processed.
+    def __init__(self, name, source, calibration, markerLength=0.2, live=None, roiTracking=True):
+        self.name = name
+        if isinstance(calibration, str):
+            # Cameras sharing a calibration file share one loaded copy
+            calibration = getCalibration(calibration)
+            cameraMatrix, distCoeffs = calibration.cameraMatrix, calibration.distCoeffs
+        else:
+            cameraMatrix, distCoeffs = calibration
+        self.tracker = ArucoTracker(cameraMatrix, distCoeffs, markerLength, roiTracking=roiTracking)
+
+        self.frameSource = None
+        if callable(source) and not isinstance(source, FrameSource):
+            self.readFrame = source
+        else:
+            if live is None:
+                live = isinstance(source, int) or (isinstance(source, str) and ('://' in source or source == 'picamera'))
+            try:
+                self.frameSource = openFrameSource(source)
+            except OSError as e:
+                raise OSError(f'Could not open camera {name}: {e}') from e
+            self.readFrame = self.frameSource.read
+
+        if live is None:
+            live = False
+        self.live = live
+        self.condition = threading.Condition()
+        self.latest = None  # (timestamp, frameIndex, frame) waiting for a worker, live cameras only
+        self.running = True
+        self.frameIndex = 0
+        self.processed = 0
+        self.dropped = 0
+        self.thread = threading.Thread(target=self.grabLoop, daemon=True) if live else None
+
+    def grabLoop(self):
+        while self.running:
+            frame = self.readFrame()
+            with self.condition:
+                if frame is None:
+                    self.running = False
+                elif self.latest is not None:
+                    self.dropped += 1
+                if frame is not None:
+                    self.latest = (time.time(), self.frameIndex, frame)
+                    self.frameIndex += 1
+                self.condition.notify_all()
+
+    def start(self):
+        if self.thread is not None:
+            self.thread.start()
+
+    def read(self):
+        # Returns (timestamp, frameIndex, frame), or None once the source has ended or the stream was stopped
+        if not self.live:
+            frame = self.readFrame() if self.running else None
+            if frame is None:
+                return None
+            self.frameIndex += 1
+            return time.time(), self.frameIndex - 1, frame
+
+        with self.condition:
+            self.condition.wait_for(lambda: self.latest is not None or not self.running)
+            item, self.latest = self.latest, None
+            return item
+
+    def stop(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
+        if self.thread is not None and self.thread.is_alive():
+            self.thread.join()
+        if self.frameSource is not None:
+            self.frameSource.close()
+
+class MultiCameraTracker:
+    # Runs the ArucoTrackers of several cameras on one shared thread pool sized to the machine's cores, OpenCV
+    # releases the GIL while detecting so the cameras really run in parallel. Each camera has at most one frame in
+    # the pool at a time, which keeps its tracker single-threaded and shares the workers fairly between cameras.
+    def __init__(self, cameras, sink, numWorkers=None):
+        self.cameras = cameras
+        self.sink = sink
+        self.numWorkers = numWorkers or os.cpu_count()
+        self.executor = ThreadPoolExecutor(max_workers=self.numWorkers)
+        self.lock = threading.Lock()
+        self.active = 0
+        self.finished = threading.Event()
+        self.errors = []
+
+    def step(self, index):
+        camera = self.cameras[index]
+        try:
+            item = camera.read()
+            if item is not None:
+                timestamp, frameIndex, frame = item
+                poses = camera.tracker.process(frame)
+                self.sink.write(makeRecords(poses, timestamp, frameIndex, index))
+                camera.processed += 1
+        except Exception as e:
+            self.errors.append((camera.name, e))
+            item = None
+
+        if item is not None and not self.finished.is_set():
+            try:
+                self.executor.submit(self.step, index)
+                return
+            except RuntimeError:  # The pool has already been shut down
+                pass
+
+        with self.lock:
+            self.active -= 1
+            if self.active == 0:
+                self.finished.set()
+
+    def run(self, duration=None):
+        # Tracks until every source has ended, duration seconds have passed or Ctrl+C is pressed
+        start = time.perf_counter()
+        self.active = len(self.cameras)
+        for index, camera in enumerate(self.cameras):
+            camera.start()
+            self.executor.submit(self.step, index)
+
+        try:
+            self.finished.wait(duration)
+        except KeyboardInterrupt:
+            pass
+        elapsed = time.perf_counter() - start
+
+        self.finished.set()
+        for camera in self.cameras:
+            camera.stop()
+        self.executor.shutdown(wait=True)
+        self.sink.close()
+
+        for name, error in self.errors:
+            print(f'Error: Camera {name} stopped: {error}')
+        for camera in self.cameras:
+            print(f'{camera.name}: {camera.processed} frames, {camera.processed / elapsed:.1f} FPS, {camera.dropped} dropped')
+        return elapsed
+
+if __name__ == "__main__":
+    # Each camera is (name, source, calibration file), see CameraStream for the kinds of sources
+    cameraConfigs = [
+        ('webcam', 0, 'cameraCalibration.npz'),
+        # ('phone', 'http://192.168.1.175:8080/video', '../Android/cameraCalibration.npz'),
+        # ('recording', 'recording.mp4', 'cameraCalibration.npz'),
+    ]
+    useSyntheticCameras = False  # Stand in synthetic cameras with a made-up calibration to try the runner without hardware
+    numSyntheticCameras = 4
+    outputPath = None  # e.g. 'poses.ndjson' or 'poses.bin' to write the records to a file instead of keeping them in memory
+
+    if useSyntheticCameras:
+        calibration = (np.array([[900.0, 0, 640], [0, 900, 360], [0, 0, 1]]), np.zeros(5))
+        cameras = [CameraStream(f'synthetic{i}', SyntheticFrameSource(seed=i), calibration) for i in range(numSyntheticCameras)]
+    else:
+        cameras = [CameraStream(name, source, calibrationPath) for name, source, calibrationPath in cameraConfigs]
+
+    if outputPath is None:
+        sink = PoseSink()
+    else:
+        sink = PoseFileSink(outputPath, 'ndjson' if outputPath.endswith('.ndjson') else 'binary')
+    runner = MultiCameraTracker(cameras, sink)
+    print(f'Tracking {len(cameras)} cameras on {runner.numWorkers} workers, press Ctrl+C to stop.')
+    runner.run()
+    if outputPath is None:
+        records = sink.records()
+        print(f'{len(records)} pose records from {len(np.unique(records[["camera", "frameIndex"]]))} frames')
+    else:
+        print(f'Saved pose records to {outputPath}')
@@ -0,0 +1,351 @@
+import os
+import argparse
+import hashlib
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import numpy as np
+import cv2
+from frameSource import listImages
+
+mapCacheDirectoryName = 'undistortionMaps'  # Created next to cameraCalibration.npz when maps are cached on disk
+imageExtensions = ('.png', '.jpg', '.jpeg', '.bmp', '.tif', '.tiff', '.webp')
+
+class UndistortionMaps:
+    # Fixed-point remap tables for one (calibration, resolution, alpha), built once with initUndistortRectifyMap.
+    # map1 holds the integer source pixel of every output pixel (CV_16SC2) and map2 the 1/32 pixel fraction, which is
+    # what remap is fastest with and about a third of the size of the float maps.
+    def __init__(self, map1, map2, newCameraMatrix, roi):
+        self.map1 = map1
+        self.map2 = map2
+        self.newCameraMatrix = newCameraMatrix
+        self.roi = tuple(int(v) for v in roi)
+
+    def apply(self, img, crop=True, dst=None):
+        # Same result as cv2.undistort with newCameraMatrix, cropped to the valid roi unless crop is False
+        dst = cv2.remap(img, self.map1, self.map2, cv2.INTER_LINEAR, dst=dst)
+        if crop:
+            x, y, w, h = self.roi
+            dst = dst[y:y + h, x:x + w]
+        return dst
+
+mapCache = {}
+mapCacheLock = threading.Lock()
+
+def undistortionMapKey(cameraMatrix, distCoeffs, imageSize, alpha):
+    # Changes whenever the calibration itself changes, not just the file it came from
+    digest = hashlib.sha1()
+    digest.update(np.ascontiguousarray(cameraMatrix, dtype=np.float64).tobytes())
+    digest.update(np.ascontiguousarray(distCoeffs, dtype=np.float64).tobytes())
+    digest.update(repr((tuple(imageSize), float(alpha))).encode())
+    return digest.hexdigest()
+
+def buildUndistortionMaps(cameraMatrix, distCoeffs, imageSize, alpha=1):
+    # alpha=1 keeps every source pixel (with black borders, cropped by roi), alpha=0 keeps only valid pixels
+    newCameraMatrix, roi = cv2.getOptimalNewCameraMatrix(cameraMatrix, distCoeffs, imageSize, alpha, imageSize)
+    map1, map2 = cv2.initUndistortRectifyMap(cameraMatrix, distCoeffs, None, newCameraMatrix, imageSize, cv2.CV_16SC2)
+    return UndistortionMaps(map1, map2, newCameraMatrix, roi)
+
+def getUndistortionMaps(cameraMatrix, distCoeffs, imageSize, alpha=1, calibrationPath=None):
+    # Returns the maps for this calibration and image size (w, h), building them only the first time they are asked
+    # for in this process. With calibrationPath they are also saved next to that file, so later runs load them instead.
+    key = undistortionMapKey(cameraMatrix, distCoeffs, imageSize, alpha)
+    with mapCacheLock:
+        maps = mapCache.get(key)
+    if maps is not None:
+        return maps
+
+    cachePath = None
+    if calibrationPath is not None:
+        cachePath = os.path.join(os.path.dirname(os.path.abspath(calibrationPath)), mapCacheDirectoryName, f'{key}.npz')
+    if cachePath is not None and os.path.exists(cachePath):
+        try:
+            with np.load(cachePath) as data:
+                maps = UndistortionMaps(data['map1'], data['map2'], data['newCameraMatrix'], data['roi'])
+        except (OSError, ValueError, KeyError) as e:
+            print(f'Warning: Ignoring unreadable undistortion maps {cachePath}: {e}')
+
+    if maps is None:
+        maps = buildUndistortionMaps(cameraMatrix, distCoeffs, imageSize, alpha)
+        if cachePath is not None:
+            # Write to a temporary file first so an interrupted run never leaves a truncated cache behind
+            os.makedirs(os.path.dirname(cachePath), exist_ok=True)
+            tmpPath = f'{cachePath}.{os.getpid()}.tmp.npz'
+            np.savez(tmpPath, map1=maps.map1, map2=maps.map2, newCameraMatrix=maps.newCameraMatrix, roi=np.array(maps.roi))
+            os.replace(tmpPath, cachePath)
+
+    with mapCacheLock:
+        return mapCache.setdefault(key, maps)
+
+# Stops the iterative point undistortion once a step moves the points by less than this (in normalized units, so 1e-8
+# is about 1e-5 pixels at a focal length of 1000). cv2.undistortPoints' default of 5 iterations is off by a few
+# tenths of a pixel in the corners of strongly distorted lenses.
+pointCriteria = (cv2.TERM_CRITERIA_COUNT | cv2.TERM_CRITERIA_EPS, 50, 1e-8)
+
+def undistortPoints(points, cameraMatrix, distCoeffs, newCameraMatrix=None, criteria=pointCriteria):
+    # Undistorts any array of pixel coordinates with a last axis of 2, such as the corners ((N, 4, 2)) or centers
+    # ((N, 2)) of a tracker's markers, in one call. Without newCameraMatrix the result is in normalized coordinates
+    # (x/z, y/z), with it in the pixels of the image undistorted with that matrix, e.g. UndistortionMaps.newCameraMatrix.
+    points = np.asarray(points)
+    if points.size == 0:
+        return np.zeros(points.shape, np.float64)
+    undistorted = cv2.undistortPointsIter(points.reshape(-1, 1, 2).astype(np.float64), cameraMatrix, distCoeffs, None,
+                                          newCameraMatrix, criteria)
+    return undistorted.reshape(points.shape)
+
+class PointUndistortionGrid:
+    # Precomputed undistortPoints results on a grid of pixel positions every `step` pixels, points in between are
+    # interpolated bilinearly. This trades accuracy for speed: the error grows with step squared (on a webcam with
+    # k1=-0.3 at most 0.02 pixel at step 8, 0.07 at 16 and 0.3 at 32, worst in the image corners), while each point
+    # costs a few array lookups instead of an iterative solve. With NumPy's fixed overhead per call that only pays off
+    # from about a thousand points per call, e.g. many frames' corners at once, below that use undistortPoints.
+    def __init__(self, cameraMatrix, distCoeffs, imageSize, step=16, newCameraMatrix=None):
+        self.step = step
+        xs = np.arange(0, imageSize[0] + step, step, dtype=np.float64)
+        ys = np.arange(0, imageSize[1] + step, step, dtype=np.float64)
+        gridPoints = np.stack(np.meshgrid(xs, ys), axis=-1)
+        self.grid = undistortPoints(gridPoints, cameraMatrix, distCoeffs, newCameraMatrix)
+
+    def apply(self, points):
+        # Points outside the image are extrapolated from the nearest grid cell, so they are less accurate
+        points = np.asarray(points, dtype=np.float64)
+        flat = points.reshape(-1, 2) / self.step
+        cells = np.floor(flat).astype(np.intp)
+        cells[:, 0] = np.clip(cells[:, 0], 0, self.grid.shape[1] - 2)
+        cells[:, 1] = np.clip(cells[:, 1], 0, self.grid.shape[0] - 2)
+        fx, fy = (flat - cells).T[:, :, None]
+        x, y = cells.T
+        top = self.grid[y, x] * (1 - fx) + self.grid[y, x + 1] * fx
+        bottom = self.grid[y + 1, x] * (1 - fx) + self.grid[y + 1, x + 1] * fx
+        return (top * (1 - fy) + bottom * fy).reshape(points.shape)
+
+pointGridCache = {}
+
+def getPointUndistortionGrid(cameraMatrix, distCoeffs, imageSize, step=16, newCameraMatrix=None):
+    # Like getUndistortionMaps, the grid is only built the first time it is asked for in this process
+    key = (undistortionMapKey(cameraMatrix, distCoeffs, imageSize, step),
+           None if newCameraMatrix is None else np.asarray(newCameraMatrix, dtype=np.float64).tobytes())
+    with mapCacheLock:
+        grid = pointGridCache.get(key)
+    if grid is None:
+        grid = PointUndistortionGrid(cameraMatrix, distCoeffs, imageSize, step, newCameraMatrix)
+        with mapCacheLock:
+            grid = pointGridCache.setdefault(key, grid)
+    return grid
+
+def initUndistortWorker(maps):
+    # Every worker starts with the parent's maps instead of building its own, and already has a core to itself
+    cv2.setNumThreads(1)
+    mapCache.update(maps)
+
+def undistortFile(fname, outputPath, cameraMatrix, distCoeffs, alpha, crop, calibrationPath):
+    # Returns outputPath, or None when the image could not be read or written
+    img = cv2.imread(fname, cv2.IMREAD_UNCHANGED)
+    if img is None:
+        print(f'Warning: Could not read {fname}')
+        return None
+
+    maps = getUndistortionMaps(cameraMatrix, distCoeffs, img.shape[1::-1], alpha, calibrationPath)
+    if not cv2.imwrite(outputPath, maps.apply(img, crop)):
+        print(f'Warning: Could not write {outputPath}')
+        return None
+    return outputPath
+
+def undistortDirectory(inputDirectory, outputDirectory, cameraMatrix, distCoeffs, alpha=1, crop=True, numWorkers=None,
+                       calibrationPath=None, extension=None):
+    # Undistorts every image in inputDirectory into outputDirectory under the same name, on a process pool. Workers
+    # read and write the images themselves, so only file names go between processes.
+    imageFiles = listImages(inputDirectory, imageExtensions)
+    if not imageFiles:
+        print(f'No images found in directory {inputDirectory}')
+        return 0
+    os.makedirs(outputDirectory, exist_ok=True)
+
+    outputPaths = []
+    for fname in imageFiles:
+        base, ext = os.path.splitext(os.path.basename(fname))
+        outputPaths.append(os.path.join(outputDirectory, base + (extension or ext)))
+
+    # Build the maps for the first image's size up front, so the workers share them instead of each building a copy
+    firstImage = cv2.imread(imageFiles[0], cv2.IMREAD_UNCHANGED)
+    if firstImage is not None:
+        getUndistortionMaps(cameraMatrix, distCoeffs, firstImage.shape[1::-1], alpha, calibrationPath)
+
+    if numWorkers is None:
+        numWorkers = os.cpu_count() or 1
+    numFiles = len(imageFiles)
+    settings = ([cameraMatrix] * numFiles, [distCoeffs] * numFiles, [alpha] * numFiles, [crop] * numFiles, [calibrationPath] * numFiles)
+
+    start = time.perf_counter()
+    lastReport = start
+    written = 0
+    if numWorkers <= 1:
+        results = map(undistortFile, imageFiles, outputPaths, *settings)
+        executor = None
+    else:
+        # Hand out images in small batches to cut down on inter-process overhead
+        chunkSize = max(1, numFiles // (numWorkers * 4))
+        executor = ProcessPoolExecutor(max_workers=numWorkers, initializer=initUndistortWorker, initargs=(dict(mapCache),))
+        results = executor.map(undistortFile, imageFiles, outputPaths, *settings, chunksize=chunkSize)
+
+    try:
+        for i, outputPath in enumerate(results, 1):
+            written += outputPath is not None
+            if time.perf_counter() - lastReport > 5:
+                lastReport = time.perf_counter()
+                print(f'{i}/{numFiles} images, {i / (lastReport - start):.1f} images/s')
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+    elapsed = time.perf_counter() - start
+    print(f'Undistorted {written}/{numFiles} images into {outputDirectory} in {elapsed:.1f} s '
+          f'({numFiles / elapsed:.1f} images/s on {numWorkers} workers)')
+    return written
+
+def undistortVideo(inputPath, outputPath, cameraMatrix, distCoeffs, alpha=1, crop=True, numWorkers=None, calibrationPath=None):
+    # Undistorts every frame of a video into a new one. Frames are decoded and encoded in order on this thread while
+    # a thread pool remaps the ones in between, handing frames to other processes would cost more than the remap.
+    capture = cv2.VideoCapture(inputPath)
+    if not capture.isOpened():
+        print(f'Error: Could not open video {inputPath}')
+        return 0
+
+    width = int(capture.get(cv2.CAP_PROP_FRAME_WIDTH))
+    height = int(capture.get(cv2.CAP_PROP_FRAME_HEIGHT))
+    fps = capture.get(cv2.CAP_PROP_FPS) or 30
+    maps = getUndistortionMaps(cameraMatrix, distCoeffs, (width, height), alpha, calibrationPath)
+    x, y, w, h = maps.roi if crop else (0, 0, width, height)
+    writer = cv2.VideoWriter(outputPath, cv2.VideoWriter_fourcc(*'mp4v'), fps, (w, h))
+    if not writer.isOpened():
+        print(f'Error: Could not create video {outputPath}')
+        capture.release()
+        return 0
+
+    if numWorkers is None:
+        numWorkers = os.cpu_count() or 1
+    start = time.perf_counter()
+    lastReport = start
+    written = 0
+    pending = []
+    with ThreadPoolExecutor(max_workers=numWorkers) as executor:
+        while True:
+            ret, frame = capture.read()
+            if ret:
+                pending.append(executor.submit(maps.apply, frame, crop))
+
+            # Keep a few frames per worker in flight and write the oldest ones as soon as they are done
+            while pending and (not ret or len(pending) > 2 * numWorkers or pending[0].done()):
+                writer.write(np.ascontiguousarray(pending.pop(0).result()))
+                written += 1
+            if not ret:
+                break
+
+            if time.perf_counter() - lastReport > 5:
+                lastReport = time.perf_counter()
+                print(f'{written} frames, {written / (lastReport - start):.1f} frames/s')
+
+    capture.release()
+    writer.release()
+    elapsed = time.perf_counter() - start
+    print(f'Undistorted {written} frames into {outputPath} in {elapsed:.1f} s ({written / elapsed:.1f} frames/s)')
+    return written
+
+def benchmarkUndistortion(cameraMatrix, distCoeffs, imageSize=(1280, 720), numImages=200, alpha=1):
+    # Compares getOptimalNewCameraMatrix and cv2.undistort on every image, as distortionCheck used to do, with
+    # cached maps and remap. The images are generated in memory so only the undistortion itself is timed.
+    rng = np.random.default_rng(0)
+    images = [rng.integers(0, 256, (imageSize[1], imageSize[0], 3), dtype=np.uint8) for _ in range(min(numImages, 10))]
+
+    start = time.perf_counter()
+    for i in range(numImages):
+        newCameraMtx, roi = cv2.getOptimalNewCameraMatrix(cameraMatrix, distCoeffs, imageSize, alpha, imageSize)
+        x, y, w, h = roi
+        expected = cv2.undistort(images[i % len(images)], cameraMatrix, distCoeffs, None, newCameraMtx)[y:y + h, x:x + w]
+    undistortTime = time.perf_counter() - start
+
+    mapCache.clear()
+    start = time.perf_counter()
+    for i in range(numImages):
+        undistorted = getUndistortionMaps(cameraMatrix, distCoeffs, imageSize, alpha).apply(images[i % len(images)])
+    remapTime = time.perf_counter() - start
+
+    difference = np.abs(expected.astype(np.int16) - undistorted).mean()
+    print(f'{numImages} images of {imageSize[0]}x{imageSize[1]}: undistort {numImages / undistortTime:.0f} images/s, '
+          f'cached remap {numImages / remapTime:.0f} images/s ({undistortTime / remapTime:.1f}x), '
+          f'mean abs difference {difference:.2f}')
+
+def benchmarkPointUndistortion(cameraMatrix, distCoeffs, imageSize=(1280, 720), numPoints=200, repeats=100, steps=(8, 16, 32)):
+    # Times getting undistorted marker coordinates from cv2.undistortPoints with its default 5 iterations,
+    # undistortPoints with pointCriteria and PointUndistortionGrid, against remapping the whole frame. The errors are
+    # in pixels of the undistorted image, relative to undistortPoints run to convergence.
+    rng = np.random.default_rng(0)
+    points = rng.uniform((0, 0), imageSize, (numPoints, 2))
+    newCameraMatrix = getUndistortionMaps(cameraMatrix, distCoeffs, imageSize).newCameraMatrix
+    reference = undistortPoints(points, cameraMatrix, distCoeffs, newCameraMatrix,
+                                (cv2.TERM_CRITERIA_COUNT | cv2.TERM_CRITERIA_EPS, 1000, 1e-14))
+
+    def timed(function):
+        start = time.perf_counter()
+        for _ in range(repeats):
+            result = function()
+        return (time.perf_counter() - start) / repeats * 1000, result
+
+    methods = [
+        ('undistortPoints (5 iterations)', lambda: cv2.undistortPoints(points.reshape(-1, 1, 2), cameraMatrix, distCoeffs, None,
+                                                                        newCameraMatrix).reshape(-1, 2)),
+        ('undistortPoints (pointCriteria)', lambda: undistortPoints(points, cameraMatrix, distCoeffs, newCameraMatrix)),
+    ]
+    for step in steps:
+        grid = getPointUndistortionGrid(cameraMatrix, distCoeffs, imageSize, step, newCameraMatrix)
+        methods.append((f'grid every {step} px', lambda grid=grid: grid.apply(points)))
+
+    image = rng.integers(0, 256, (imageSize[1], imageSize[0], 3), dtype=np.uint8)
+    maps = getUndistortionMaps(cameraMatrix, distCoeffs, imageSize)
+    remapTime, _ = timed(lambda: maps.apply(image, crop=False))
+
+    print(f'{numPoints} points in {imageSize[0]}x{imageSize[1]} images, remapping the whole frame takes {remapTime:.2f} ms:')
+    for name, function in methods:
+        elapsed, result = timed(function)
+        error = np.linalg.norm(result - reference, axis=1)
+        print(f'  {name}: {elapsed:.3f} ms ({remapTime / elapsed:.0f}x faster than remap), '
+              f'max error {error.max():.1e} px, mean {error.mean():.1e} px')
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Undistorts and crops a whole image directory or video with a saved '
+                                                 'calibration. Without arguments it benchmarks cached remapping instead.')
+    parser.add_argument('input', nargs='?', help='image directory or video file')
+    parser.add_argument('output', nargs='?', help='output directory, or output video file for a video input')
+    parser.add_argument('--calibration', default='cameraCalibration.npz', help='calibration file (default: %(default)s)')
+    parser.add_argument('--alpha', type=float, default=1.0, help='1 keeps every source pixel, 0 only valid ones (default: %(default)s)')
+    parser.add_argument('--no-crop', dest='crop', action='store_false', help='keep the full frame instead of cropping to the valid roi')
+    parser.add_argument('--workers', type=int, default=None, help='number of workers (default: one per core)')
+    parser.add_argument('--extension', default=None, help='output image extension such as .png (default: same as the input)')
+    parser.add_argument('--cache-maps', action='store_true', help=f'also save the maps in {mapCacheDirectoryName}/ next to the '
+                                                                  'calibration file and reuse them in later runs')
+    args = parser.parse_args()
+
+    if args.input is not None and args.output is None:
+        parser.error('the output is required when an input is given')
+
+    if os.path.exists(args.calibration):
+        with np.load(args.calibration) as data:
+            cameraMatrix = data['cameraMatrix']
+            distCoeffs = data['distCoeffs']
+    elif args.input is None:
+        # A typical webcam calibration, to try the benchmark before calibrating
+        cameraMatrix = np.array([[900.0, 0, 640], [0, 900, 360], [0, 0, 1]])
+        distCoeffs = np.array([[-0.3, 0.12, 0.001, -0.001, -0.02]])
+    else:
+        parser.error(f'calibration file {args.calibration} not found')
+
+    calibrationPath = args.calibration if args.cache_maps else None
+    if args.input is None:
+        for imageSize in ((800, 600), (1280, 720), (1920, 1080)):
+            benchmarkUndistortion(cameraMatrix, distCoeffs, imageSize)
+        for numPoints in (20, 200, 2000):
+            benchmarkPointUndistortion(cameraMatrix, distCoeffs, numPoints=numPoints)
+    elif os.path.isdir(args.input):
+        undistortDirectory(args.input, args.output, cameraMatrix, distCoeffs, args.alpha, args.crop, args.workers, calibrationPath, args.extension)
+    else:
+        undistortVideo(args.input, args.output, cameraMatrix, distCoeffs, args.alpha, args.crop, args.workers, calibrationPath)
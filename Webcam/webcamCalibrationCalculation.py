@@ -2,79 +2,794 @@
 import os
 import numpy as np
 import cv2
-import glob
+import hashlib
+import threading
+import time
+import zipfile
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from calibrationStore import CalibrationDatabase, databaseName
+from frameSource import cornerSidecarSuffix, listImages as listDirectoryImages, loadImageArray
+
+subPixWinSize = (11, 11)
+subPixCriteria = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, 30, 0.001)
+cornerCacheName = 'cornerCache.npz'  # Stored inside the image directory
+pyramidMaxWidth = 1000  # Width the coarse pyramid level is reduced to before searching for the chessboard
+imageExtensions = ('.png', '.webp', '.npy')  # Formats the capture scripts can write
 
 def splitFn(fname):
     path, fname = os.path.split(fname)
     name, ext = os.path.splitext(fname)
     return path, name, ext
 
-def main(imageDirectory, patternSize, squareSize):
+def listImages(imageDirectory):
+    # Skips the corner sidecars (cornerSidecarSuffix) saved next to each capture
+    return listDirectoryImages(imageDirectory, imageExtensions)
+
+def readImage(fname):
+    # Raw .npy captures hold the BGR array exactly as it came from the camera
+    if fname.lower().endswith('.npy'):
+        return loadImageArray(fname)
+    return cv2.imread(fname)
+
+def readGray(fname):
+    img = readImage(fname)
+    if img is None or img.ndim == 2:
+        return img
+    return cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+
+def loadCornerSidecar(fname, patternSize):
+    # Returns the corners the capture script already found in this image, if it saved them
+    sidecarPath = os.path.splitext(fname)[0] + cornerSidecarSuffix
+    if not os.path.exists(sidecarPath):
+        return None
+    try:
+        corners = np.load(sidecarPath).astype(np.float32)
+    except (OSError, ValueError):
+        return None
+    return corners.reshape(-1, 1, 2) if corners.size == 2 * np.prod(patternSize) else None
+
+def makePatternPoints(patternSize, squareSize):
     patternPoints = np.zeros((np.prod(patternSize), 3), np.float32)
     patternPoints[:, :2] = np.indices(patternSize).T.reshape(-1, 2)
     patternPoints = np.expand_dims(np.asarray(patternPoints), -2)
     patternPoints *= squareSize
+    return patternPoints
+
+def initDetectionWorker():
+    # Every worker already has a core to itself, so stop OpenCV from spawning extra threads on top of it
+    cv2.setNumThreads(1)
+
+def findChessboardCornersPyramid(gray, patternSize):
+    # Search a downscaled pyramid level first, the full resolution image is never searched when that fails
+    coarse = gray
+    scale = 1
+    while coarse.shape[1] > pyramidMaxWidth:
+        coarse = cv2.pyrDown(coarse)
+        scale *= 2
+
+    ret, corners = cv2.findChessboardCorners(coarse, patternSize, None)
+    if not ret:
+        return ret, corners
+
+    # pyrDown keeps pixel 2x of the finer level at pixel x, so mapping back is a plain multiply
+    return ret, corners * scale
+
+def detectCornersInImage(gray, patternSize, usePyramid=False, corners=None):
+    # Corners that are already known only need refining, the chessboard search is skipped
+    if corners is not None:
+        ret = True
+    elif usePyramid:
+        ret, corners = findChessboardCornersPyramid(gray, patternSize)
+    else:
+        ret, corners = cv2.findChessboardCorners(gray, patternSize, None)
+    if not ret:
+        return None
+
+    return cv2.cornerSubPix(gray, corners, subPixWinSize, (-1, -1), subPixCriteria)
+
+def detectCorners(fname, patternSize, usePyramid=False):
+    gray = readGray(fname)
+    if gray is None:
+        return fname, None
+
+    return fname, detectCornersInImage(gray, patternSize, usePyramid, loadCornerSidecar(fname, patternSize))
+
+def detectAllCorners(imageFiles, patternSize, numWorkers=None, usePyramid=False):
+    # Yields (fname, corners) in the same order as imageFiles, corners is None for rejected images
+    if numWorkers is None:
+        numWorkers = os.cpu_count() or 1
 
-    imageFiles = glob.glob(os.path.join(imageDirectory, '*.png'))
+    if numWorkers <= 1 or len(imageFiles) <= 1:
+        for fname in imageFiles:
+            yield detectCorners(fname, patternSize, usePyramid)
+        return
+
+    # Hand out images in small batches to cut down on inter-process overhead
+    chunkSize = max(1, len(imageFiles) // (numWorkers * 4))
+    numFiles = len(imageFiles)
+    with ProcessPoolExecutor(max_workers=numWorkers, initializer=initDetectionWorker) as executor:
+        yield from executor.map(detectCorners, imageFiles, [patternSize] * numFiles, [usePyramid] * numFiles, chunksize=chunkSize)
+
+def benchmarkDetection(imageDirectory, patternSize):
+    # Compares full resolution detection against the coarse-to-fine pyramid path on a single core
+    imageFiles = listImages(imageDirectory)
     if not imageFiles:
         print(f"No images found in directory {imageDirectory}")
         return
 
-    img = cv2.imread(imageFiles[0], cv2.IMREAD_GRAYSCALE)
+    timings = {}
+    results = {}
+    for usePyramid in (False, True):
+        start = time.perf_counter()
+        results[usePyramid] = dict(detectAllCorners(imageFiles, patternSize, 1, usePyramid))
+        timings[usePyramid] = time.perf_counter() - start
+
+    deltas = []
+    mismatched = 0
+    for fname in imageFiles:
+        full, pyramid = results[False][fname], results[True][fname]
+        if full is None or pyramid is None:
+            mismatched += (full is None) != (pyramid is None)
+            continue
+        deltas.append(np.sum((full - pyramid) ** 2, axis=-1).ravel())
+
+    print(f'Full resolution: {timings[False]:.2f}s, accepted {sum(c is not None for c in results[False].values())} out of {len(imageFiles)}')
+    print(f'Pyramid: {timings[True]:.2f}s, accepted {sum(c is not None for c in results[True].values())} out of {len(imageFiles)}')
+    print(f'Speedup: {timings[False] / timings[True]:.2f}x, images accepted by only one path: {mismatched}')
+    if deltas:
+        print(f'Corner RMS delta: {np.sqrt(np.mean(np.concatenate(deltas))):.4f} px')
+
+def cornerCacheKey(fname, patternSize, usePyramid=False):
+    digest = hashlib.sha1()
+    with open(fname, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+
+    # Corners saved at capture time change the result, so they are part of the key as well
+    sidecarPath = os.path.splitext(fname)[0] + cornerSidecarSuffix
+    if os.path.exists(sidecarPath):
+        with open(sidecarPath, 'rb') as f:
+            digest.update(f.read())
+
+    # The detection settings are part of the key, so changing any of them invalidates the stored corners
+    settings = (tuple(patternSize), subPixWinSize, subPixCriteria, pyramidMaxWidth if usePyramid else None)
+    digest.update(repr(settings).encode())
+    return digest.hexdigest()
+
+def loadCornerCache(cachePath):
+    if not os.path.exists(cachePath):
+        return {}
+
+    try:
+        with np.load(cachePath) as data:
+            return {key: data[key] for key in data.files}
+    except (OSError, ValueError, zipfile.BadZipFile):
+        print(f"Ignoring unreadable corner cache {cachePath}")
+        return {}
+
+def saveCornerCache(cachePath, cache):
+    # Write to a temporary file first so an interrupted run never leaves a truncated cache behind
+    tmpPath = cachePath + '.tmp.npz'
+    np.savez(tmpPath, **cache)
+    os.replace(tmpPath, cachePath)
+
+def rodriguesBatch(rvecs):
+    # N x 3 rotation vectors to N x 3 x 3 rotation matrices
+    rvecs = np.asarray(rvecs, np.float64).reshape(-1, 3)
+    theta = np.linalg.norm(rvecs, axis=1)
+    axis = rvecs / np.where(theta < 1e-12, 1.0, theta)[:, None]
+
+    skew = np.zeros((len(rvecs), 3, 3))
+    skew[:, 0, 1], skew[:, 0, 2] = -axis[:, 2], axis[:, 1]
+    skew[:, 1, 0], skew[:, 1, 2] = axis[:, 2], -axis[:, 0]
+    skew[:, 2, 0], skew[:, 2, 1] = -axis[:, 1], axis[:, 0]
+
+    sinTheta = np.sin(theta)[:, None, None]
+    cosTheta = np.cos(theta)[:, None, None]
+    return np.eye(3) + sinTheta * skew + (1 - cosTheta) * (skew @ skew)
+
+def projectPointsBatch(objPoints, rvecs, tvecs, cameraMatrix, distCoeffs):
+    # Same camera model as cv2.projectPoints, evaluated for every view and corner at once
+    objPoints = np.asarray(objPoints, np.float64).reshape(len(rvecs), -1, 3)
+    tvecs = np.asarray(tvecs, np.float64).reshape(-1, 3)
+    coeffs = np.zeros(14)
+    distCoeffs = np.ravel(distCoeffs) if distCoeffs is not None else np.zeros(0)
+    coeffs[:len(distCoeffs)] = distCoeffs
+
+    if np.any(coeffs[12:]):
+        # The tilted sensor model is rare enough that it is not worth vectorizing
+        return np.stack([cv2.projectPoints(objPoints[i], rvecs[i], tvecs[i], cameraMatrix, distCoeffs)[0].reshape(-1, 2)
+                         for i in range(len(objPoints))])
+
+    camPoints = np.einsum('nij,nmj->nmi', rodriguesBatch(rvecs), objPoints) + tvecs[:, None, :]
+    x = camPoints[..., 0] / camPoints[..., 2]
+    y = camPoints[..., 1] / camPoints[..., 2]
+
+    k1, k2, p1, p2, k3, k4, k5, k6, s1, s2, s3, s4 = coeffs[:12]
+    r2 = x * x + y * y
+    r4 = r2 * r2
+    r6 = r4 * r2
+    radial = (1 + k1 * r2 + k2 * r4 + k3 * r6) / (1 + k4 * r2 + k5 * r4 + k6 * r6)
+    xd = x * radial + 2 * p1 * x * y + p2 * (r2 + 2 * x * x) + s1 * r2 + s2 * r4
+    yd = y * radial + p1 * (r2 + 2 * y * y) + 2 * p2 * x * y + s3 * r2 + s4 * r4
+
+    # Like cv2.projectPoints, any skew term in the camera matrix is ignored
+    u = cameraMatrix[0, 0] * xd + cameraMatrix[0, 2]
+    v = cameraMatrix[1, 1] * yd + cameraMatrix[1, 2]
+    return np.stack([u, v], axis=-1)
+
+def computeReprojectionErrors(objPoints, imgPoints, rvecs, tvecs, cameraMatrix, distCoeffs):
+    # Returns the RMS error of every view (N) and the residual of every corner (N x M x 2) in pixels
+    projected = projectPointsBatch(objPoints, rvecs, tvecs, cameraMatrix, distCoeffs)
+    perCornerResiduals = np.asarray(imgPoints, np.float64).reshape(projected.shape) - projected
+    perViewErrors = np.sqrt(np.mean(np.sum(perCornerResiduals ** 2, axis=-1), axis=1))
+    return perViewErrors, perCornerResiduals
+
+def viewFeatures(imgPoints, patternSize, imageSize):
+    # Describes each view by where the board sits, how large it appears and how it is tilted, all roughly in [-1, 1]
+    grid = np.asarray(imgPoints, np.float64).reshape(len(imgPoints), patternSize[1], patternSize[0], 2)
+    w, h = imageSize
+    center = grid.mean(axis=(1, 2)) / (w, h) * 2 - 1
+
+    topLeft, topRight = grid[:, 0, 0], grid[:, 0, -1]
+    bottomLeft, bottomRight = grid[:, -1, 0], grid[:, -1, -1]
+    diagonal1, diagonal2 = bottomRight - topLeft, bottomLeft - topRight
+    area = 0.5 * np.abs(diagonal1[:, 0] * diagonal2[:, 1] - diagonal1[:, 1] * diagonal2[:, 0])
+    size = np.sqrt(area / (w * h))
+
+    # Perspective foreshortening makes the edge nearer the camera longer than the opposite one
+    top = np.linalg.norm(topRight - topLeft, axis=1)
+    bottom = np.linalg.norm(bottomRight - bottomLeft, axis=1)
+    left = np.linalg.norm(bottomLeft - topLeft, axis=1)
+    right = np.linalg.norm(bottomRight - topRight, axis=1)
+    tiltX = (top - bottom) / (top + bottom)
+    tiltY = (left - right) / (left + right)
+
+    # findChessboardCorners may start from either end of the board, which reverses the grid and flips the signs of the
+    # board axes and both tilts. Tilts are therefore expressed along the board axes in image coordinates and the angle
+    # is doubled, so a reversed detection of the same pose gives the same features.
+    across = (topRight - topLeft) + (bottomRight - bottomLeft)
+    across /= np.linalg.norm(across, axis=1, keepdims=True)
+    down = (bottomLeft - topLeft) + (bottomRight - topRight)
+    down /= np.linalg.norm(down, axis=1, keepdims=True)
+    tilt = tiltX[:, None] * down + tiltY[:, None] * across
+    angle = 2 * np.arctan2(across[:, 1], across[:, 0])
+    return np.column_stack([center, size, tilt * 4, np.cos(angle) * 0.5, np.sin(angle) * 0.5])
+
+def selectDiverseViews(imgPoints, patternSize, imageSize, maxViews):
+    # Greedy farthest-point selection, returns the sorted indices of at most maxViews mutually dissimilar views
+    if len(imgPoints) <= maxViews:
+        return np.arange(len(imgPoints))
+
+    features = viewFeatures(imgPoints, patternSize, imageSize)
+
+    # Start from the most typical view, then keep adding the view least like any that were already picked
+    selected = [int(np.argmin(np.linalg.norm(features - features.mean(axis=0), axis=1)))]
+    distances = np.linalg.norm(features - features[selected[0]], axis=1)
+    for _ in range(maxViews - 1):
+        nextView = int(np.argmax(distances))
+        selected.append(nextView)
+        distances = np.minimum(distances, np.linalg.norm(features - features[nextView], axis=1))
+
+    return np.sort(selected)
+
+def benchmarkViewSelection(numPoses=30, duplicatesPerPose=5, maxViews=30, patternSize=(9, 6), squareSize=0.025):
+    # Mimics the auto-capture scripts: a number of distinct poses, each captured several times while barely moving
+    rng = np.random.default_rng(0)
+    imageSize = (1280, 720)
+    trueCameraMatrix = np.array([[900.0, 0, 640], [0, 900.0, 360], [0, 0, 1]])
+    trueDistCoeffs = np.array([-0.25, 0.08, 0.001, -0.001, 0.0])
+
+    patternPoints = makePatternPoints(patternSize, squareSize).reshape(-1, 3)
+    boardCenter = patternPoints.mean(axis=0)
+
+    objPoints = []
+    imgPoints = []
+    while len(imgPoints) < numPoses * duplicatesPerPose:
+        rvec = rng.normal(0, 0.35, 3)
+        tvec = np.array([rng.uniform(-0.15, 0.15), rng.uniform(-0.08, 0.08), rng.uniform(0.35, 0.8)])
+        for _ in range(duplicatesPerPose):
+            R, _ = cv2.Rodrigues(rvec + rng.normal(0, 0.005, 3))
+            t = tvec + rng.normal(0, 0.002, 3) - R @ boardCenter
+            corners, _ = cv2.projectPoints(patternPoints, R, t, trueCameraMatrix, trueDistCoeffs)
+            corners = corners + rng.normal(0, 0.1, corners.shape)
+            if np.all((corners >= 0) & (corners < imageSize)):
+                objPoints.append(patternPoints)
+                imgPoints.append(corners.astype(np.float32))
+
+    results = {}
+    for label, views in (('All views', np.arange(len(imgPoints))), ('Selected views', selectDiverseViews(imgPoints, patternSize, imageSize, maxViews))):
+        start = time.perf_counter()
+        ret, cameraMatrix, distCoeffs, _, _ = cv2.calibrateCamera([objPoints[i] for i in views], [imgPoints[i] for i in views], imageSize, None, None)
+        results[label] = time.perf_counter() - start
+        focalError = np.abs(cameraMatrix[[0, 1], [0, 1]] - trueCameraMatrix[[0, 1], [0, 1]]).max()
+        centerError = np.abs(cameraMatrix[[0, 1], [2, 2]] - trueCameraMatrix[[0, 1], [2, 2]]).max()
+        print(f'{label}: {len(views)} views solved in {results[label]:.2f}s, RMS {ret:.4f}, '
+              f'focal error {focalError:.2f} px, principal point error {centerError:.2f} px, k1 {distCoeffs.ravel()[0]:.4f}')
+
+    print(f'Speedup: {results["All views"] / results["Selected views"]:.1f}x')
+
+def calibrateWithOutlierRejection(objPoints, imgPoints, imageSize, viewNames, maxViewError, maxIterations=5, minViews=10):
+    # Drops views whose RMS error is above maxViewError and recalibrates, each pass starting from the previous solution
+    keptViews = np.arange(len(objPoints))
+    cameraMatrix, distCoeffs, flags = None, None, 0
+    droppedViews = []
+    for iteration in range(1, maxIterations + 1):
+        start = time.perf_counter()
+        passObjPoints = [objPoints[i] for i in keptViews]
+        passImgPoints = [imgPoints[i] for i in keptViews]
+        ret, cameraMatrix, distCoeffs, rvecs, tvecs = cv2.calibrateCamera(passObjPoints, passImgPoints, imageSize, cameraMatrix, distCoeffs, flags=flags)
+        perViewErrors, _ = computeReprojectionErrors(passObjPoints, passImgPoints, rvecs, tvecs, cameraMatrix, distCoeffs)
+        outliers = perViewErrors > maxViewError
+        print(f'Pass {iteration}: RMS {ret:.4f} on {len(keptViews)} views in {time.perf_counter() - start:.2f}s, '
+              f'{np.count_nonzero(outliers)} views above {maxViewError} px')
+
+        if not outliers.any() or iteration == maxIterations:
+            break
+        if len(keptViews) - np.count_nonzero(outliers) < minViews:
+            print(f'Stopping, dropping these views would leave fewer than {minViews} views')
+            break
+
+        for i, error in zip(keptViews[outliers], perViewErrors[outliers]):
+            droppedViews.append(viewNames[i])
+            print(f'Dropping {viewNames[i]} ({error:.3f} px)')
+        keptViews = keptViews[~outliers]
+        flags = cv2.CALIB_USE_INTRINSIC_GUESS
+
+    print(f'Outlier rejection ran {iteration} passes and dropped {len(droppedViews)} views')
+    return ret, cameraMatrix, distCoeffs, rvecs, tvecs, keptViews
+
+class IncrementalCalibrator:
+    # Keeps cameraMatrix/distCoeffs/rms up to date as corner sets arrive, re-solving at most once every solveInterval
+    # seconds. Solves run on a worker thread of their own, so addCorners and update stay cheap on the capture path and
+    # a new solve only starts once the previous one has finished. background=False solves inside update() instead.
+    def __init__(self, patternSize, squareSize, imageSize, minViews=10, solveInterval=2.0, maxViews=40,
+                 convergenceTolerance=0.002, convergedSolves=3, background=True):
+        self.patternSize = patternSize
+        self.patternPoints = makePatternPoints(patternSize, squareSize)
+        self.imageSize = imageSize
+        self.minViews = minViews
+        self.solveInterval = solveInterval
+        self.maxViews = maxViews
+        self.convergenceTolerance = convergenceTolerance
+        self.convergedSolves = convergedSolves
+
+        self.lock = threading.Lock()
+        self.imgPoints = []
+        self.estimate = None  # (cameraMatrix, distCoeffs, rms), only ever replaced as a whole
+        self.numSolves = 0
+        self.stableSolves = 0
+        self.converged = False
+        self.newViews = 0
+        self.lastSolveTime = 0.0
+        self.executor = ThreadPoolExecutor(max_workers=1) if background else None
+        self.pending = None  # Future of the background solve in progress
+
+    @property
+    def cameraMatrix(self):
+        estimate = self.estimate
+        return None if estimate is None else estimate[0]
+
+    @property
+    def distCoeffs(self):
+        estimate = self.estimate
+        return None if estimate is None else estimate[1]
+
+    @property
+    def rms(self):
+        estimate = self.estimate
+        return None if estimate is None else estimate[2]
+
+    def addCorners(self, corners):
+        with self.lock:
+            self.imgPoints.append(np.asarray(corners, np.float32).reshape(-1, 1, 2))
+            self.newViews += 1
+
+    def update(self, force=False):
+        # Starts a solve when one is due and returns True when a new estimate was published since the last call, cheap
+        # to call on every frame. force waits for the solve in progress, then solves on every view captured so far.
+        published = False
+        if self.pending is not None and (force or self.pending.done()):
+            self.pending.result()  # Re-raises anything the solve raised
+            self.pending = None
+            published = True
+        if self.pending is not None:
+            return False
+
+        with self.lock:
+            if len(self.imgPoints) < self.minViews or self.newViews == 0:
+                return published
+            if not force and time.monotonic() - self.lastSolveTime < self.solveInterval:
+                return published
+            views = list(self.imgPoints)
+            self.newViews = 0
+
+        if force or self.executor is None:
+            self.solve(views)
+            return True
+        self.pending = self.executor.submit(self.solve, views)
+        return published
+
+    def solve(self, views):
+        # Capping the number of views keeps every solve about as cheap as the first one
+        if self.maxViews is not None and len(views) > self.maxViews:
+            views = [views[i] for i in selectDiverseViews(views, self.patternSize, self.imageSize, self.maxViews)]
+
+        # Warm start from the previous estimate so each solve only has to make a small correction
+        previous = self.estimate
+        if previous is None:
+            ret, cameraMatrix, distCoeffs, _, _ = cv2.calibrateCamera([self.patternPoints] * len(views), views, self.imageSize, None, None)
+        else:
+            ret, cameraMatrix, distCoeffs, _, _ = cv2.calibrateCamera([self.patternPoints] * len(views), views, self.imageSize,
+                                                                      previous[0].copy(), previous[1].copy(),
+                                                                      flags=cv2.CALIB_USE_INTRINSIC_GUESS)
+
+        with self.lock:
+            if previous is not None:
+                before = previous[0][[0, 1, 0, 1], [0, 1, 2, 2]]
+                after = cameraMatrix[[0, 1, 0, 1], [0, 1, 2, 2]]
+                change = np.max(np.abs(after - before) / np.abs(before))
+                self.stableSolves = self.stableSolves + 1 if change < self.convergenceTolerance else 0
+                self.converged = self.stableSolves >= self.convergedSolves
+
+            self.estimate = (cameraMatrix, distCoeffs, ret)
+            self.numSolves += 1
+            # Counted from the end of the solve, so a slow solve still leaves the capture loop solveInterval to itself
+            self.lastSolveTime = time.monotonic()
+
+    def status(self):
+        # Reads the estimate once, so the numbers shown always come from the same solve
+        estimate = self.estimate
+        if estimate is None:
+            return f'{len(self.imgPoints)}/{self.minViews} views'
+        cameraMatrix, _, rms = estimate
+        state = 'converged' if self.converged else 'converging'
+        return (f'{len(self.imgPoints)} views, RMS {rms:.3f}, fx {cameraMatrix[0, 0]:.1f} fy {cameraMatrix[1, 1]:.1f} '
+                f'cx {cameraMatrix[0, 2]:.1f} cy {cameraMatrix[1, 2]:.1f} ({state})')
+
+    def save(self, path):
+        cameraMatrix, distCoeffs, rms = self.estimate
+        np.savez(path, cameraMatrix=cameraMatrix, distCoeffs=distCoeffs, rms=rms)
+
+    def close(self):
+        # Waits for the solve in progress and stops the worker thread
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+
+class CaptureGate:
+    # Cheap checks that keep the auto-capture scripts from running chessboard detection on frames that could never be
+    # worth saving, and from saving views that add nothing. check() works on a copy of the frame shrunk to
+    # analysisWidth: a large mean change since the previous frame means the board is moving (and smeared), almost no
+    # change since the last captured frame means it is still held where it was captured, and a low Laplacian variance
+    # means it is out of focus. isNovel() compares the detected board's position, size and tilt (viewFeatures) with
+    # every view captured so far.
+    def __init__(self, patternSize, analysisWidth=320, maxMotion=3.0, minSharpness=200.0, minNovelty=0.1):
+        self.patternSize = patternSize
+        self.analysisWidth = analysisWidth
+        self.maxMotion = maxMotion  # Mean absolute gray level change between consecutive shrunk frames
+        self.minSharpness = minSharpness  # Variance of the Laplacian of the shrunk frame
+        self.minNovelty = minNovelty  # Distance in viewFeatures space to the nearest captured view
+        self.previous = None
+        self.lastCaptured = None  # Shrunk copy of the last captured frame
+        self.features = []
+        self.skipped = {'moving': 0, 'unchanged': 0, 'blurry': 0, 'duplicate': 0}
+        self.motion = 0.0
+        self.sharpness = 0.0
+
+    def check(self, gray):
+        # Returns None when the frame should go on to detection, otherwise 'moving', 'unchanged' or 'blurry'
+        scale = self.analysisWidth / gray.shape[1]
+        small = cv2.resize(gray, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA) if scale < 1 else gray
+        previous, self.previous = self.previous, small
+
+        if previous is not None and previous.shape == small.shape:
+            self.motion = cv2.norm(small, previous, cv2.NORM_L1) / small.size
+            if self.motion > self.maxMotion:
+                self.skipped['moving'] += 1
+                return 'moving'
+
+        if self.lastCaptured is not None and self.lastCaptured.shape == small.shape:
+            if cv2.norm(small, self.lastCaptured, cv2.NORM_L1) / small.size < self.maxMotion:
+                self.skipped['unchanged'] += 1
+                return 'unchanged'
+
+        self.sharpness = cv2.meanStdDev(cv2.Laplacian(small, cv2.CV_16S))[1][0, 0] ** 2
+        if self.sharpness < self.minSharpness:
+            self.skipped['blurry'] += 1
+            return 'blurry'
+        return None
+
+    def isNovel(self, corners, imageSize):
+        if not self.features:
+            return True
+        features = viewFeatures([corners], self.patternSize, imageSize)[0]
+        if np.min(np.linalg.norm(np.array(self.features) - features, axis=1)) < self.minNovelty:
+            self.skipped['duplicate'] += 1
+            return False
+        return True
+
+    def add(self, corners, imageSize):
+        # Call for every view that was captured, right after the check() of its frame
+        self.features.append(viewFeatures([corners], self.patternSize, imageSize)[0])
+        self.lastCaptured = self.previous
+
+    def status(self):
+        return (f'motion {self.motion:.1f}, sharpness {self.sharpness:.0f}, skipped {self.skipped["moving"]} moving '
+                f'{self.skipped["unchanged"]} unchanged {self.skipped["blurry"]} blurry {self.skipped["duplicate"]} duplicate')
+
+def syntheticCaptureSequence(numFrames=600, patternSize=(9, 6), imageSize=(800, 600), seed=0):
+    # Mimics someone holding a board up to a camera at 30 FPS: it moves to a new pose with motion blur, is held fairly
+    # still there for a second or two, and sometimes comes back to a pose it was already in. Yields gray frames.
+    rng = np.random.default_rng(seed)
+    square = 40
+    columns, rows = patternSize[0] + 1, patternSize[1] + 1
+    board = np.kron((np.indices((rows, columns)).sum(axis=0) % 2) * 255, np.ones((square, square))).astype(np.uint8)
+    board = cv2.copyMakeBorder(board, square, square, square, square, cv2.BORDER_CONSTANT, value=255)
+    boardCorners = np.float32([[0, 0], [board.shape[1], 0], [board.shape[1], board.shape[0]], [0, board.shape[0]]])
+    background = cv2.GaussianBlur(rng.integers(40, 120, (imageSize[1], imageSize[0]), dtype=np.uint8), (0, 0), 3)
+    w, h = imageSize
+
+    def randomPose():
+        # Image positions of the board's four outer corners
+        width = rng.uniform(0.35, 0.6) * w
+        height = width * board.shape[0] / board.shape[1]
+        center = rng.uniform((width * 0.7, height * 0.7), (w - width * 0.7, h - height * 0.7))
+        angle = rng.uniform(-0.3, 0.3)
+        rotation = np.array([[np.cos(angle), -np.sin(angle)], [np.sin(angle), np.cos(angle)]])
+        quad = (np.array([[-1, -1], [1, -1], [1, 1], [-1, 1]]) * (width / 2, height / 2)) @ rotation.T
+        quad *= 1 + rng.uniform(-0.15, 0.15, (4, 1))  # Perspective from tilting the board
+        return np.float32(quad + center)
+
+    poses = [randomPose()]
+    pose = poses[0]
+    frameIndex = 0
+    while frameIndex < numFrames:
+        target = poses[rng.integers(len(poses))] if len(poses) > 2 and rng.random() < 0.3 else randomPose()
+        poses.append(target)
+        moveFrames = int(rng.integers(8, 20))
+        holdFrames = int(rng.integers(30, 60))
+        for i in range(moveFrames + holdFrames):
+            if frameIndex >= numFrames:
+                return
+            previousPose = pose
+            if i < moveFrames:
+                pose = poses[-2] + (target - poses[-2]) * (i + 1) / moveFrames
+            else:
+                pose = target + rng.normal(0, 0.3, target.shape).astype(np.float32)  # Hand tremor
+
+            frame = background.copy()
+            H = cv2.getPerspectiveTransform(boardCorners, pose)
+            warped = cv2.warpPerspective(board, H, imageSize, borderValue=0)
+            mask = cv2.warpPerspective(np.full(board.shape, 255, np.uint8), H, imageSize) > 0
+            frame[mask] = warped[mask]
+
+            # Smear the frame along the direction the board moved during the exposure
+            shift = (pose - previousPose).mean(axis=0)
+            length = int(np.hypot(*shift))
+            if length > 1:
+                kernel = np.zeros((2 * length + 1, 2 * length + 1), np.float32)
+                direction = shift / np.hypot(*shift)
+                cv2.line(kernel, (int(length - direction[0] * length / 2), int(length - direction[1] * length / 2)),
+                         (int(length + direction[0] * length / 2), int(length + direction[1] * length / 2)), 1.0)
+                frame = cv2.filter2D(frame, -1, kernel / kernel.sum())
+
+            noise = rng.normal(0, 2, frame.shape)
+            yield np.clip(frame + noise, 0, 255).astype(np.uint8)
+            frameIndex += 1
+
+def benchmarkCaptureGate(patternSize=(9, 6), numFrames=600, captureInterval=30):
+    # Runs the auto-capture rule (capture whenever the board is found and captureInterval frames have passed) on a
+    # synthetic hand-held sequence, with and without a CaptureGate in front of detection and saving
+    frames = list(syntheticCaptureSequence(numFrames, patternSize))
+    imageSize = frames[0].shape[::-1]
+
+    for label, gate in (('Without gate', None), ('With gate', CaptureGate(patternSize))):
+        detections = 0
+        captured = []
+        lastCapture = -captureInterval
+        start = time.perf_counter()
+        for index, gray in enumerate(frames):
+            if gate is not None and gate.check(gray) is not None:
+                continue
+            detections += 1
+            ret, corners = cv2.findChessboardCorners(gray, patternSize, None)
+            if not ret or index - lastCapture < captureInterval:
+                continue
+            if gate is not None:
+                if not gate.isNovel(corners, imageSize):
+                    continue
+                gate.add(corners, imageSize)
+            captured.append((gray, corners))
+            lastCapture = index
+        elapsed = time.perf_counter() - start
+
+        # Sharpness of the captured images at full resolution, and how many of them repeat an earlier pose
+        sharpness = np.median([cv2.Laplacian(gray, cv2.CV_64F).var() for gray, _ in captured]) if captured else 0
+        features = viewFeatures([corners for _, corners in captured], patternSize, imageSize) if captured else np.zeros((0, 7))
+        duplicates = sum(np.min(np.linalg.norm(features[:i] - features[i], axis=1)) < 0.1 for i in range(1, len(features)))
+        print(f'{label}: {len(frames)} frames in {elapsed:.1f}s ({elapsed / len(frames) * 1000:.1f} ms per frame), '
+              f'{detections} detections, {len(captured)} captured, {duplicates} of them repeat an earlier pose, '
+              f'median sharpness {sharpness:.0f}')
+        if gate is not None:
+            print(f'Gate: {gate.status()}')
+
+def saveCalibration(cameraId, imageSize, cameraMatrix, distCoeffs, rms, databasePath=databaseName, exportPath='cameraCalibration.npz', **arrays):
+    # Adds a new version to the calibration database instead of replacing the last one, then writes it to exportPath
+    # (if given) for the trackers. Replacing that file loses nothing, every earlier version stays in the history.
+    database = CalibrationDatabase(databasePath)
+    try:
+        calibrationId = database.add(cameraId, imageSize, cameraMatrix, distCoeffs, rms, **arrays)
+        if exportPath is not None:
+            database.exportNpz(database.get(calibrationId), exportPath)
+        numVersions = len(database.history(cameraId, imageSize))
+    finally:
+        database.close()
+    print(f'Saved calibration {calibrationId} of camera {cameraId} at {imageSize[0]}x{imageSize[1]} to {databasePath} '
+          f'({numVersions} versions)')
+    return calibrationId
+
+def watchDirectory(imageDirectory, patternSize, squareSize, pollInterval=1.0, usePyramid=False, stopWhenConverged=True,
+                   cameraId='camera', databasePath=databaseName):
+    # Calibrates from images as they are written into imageDirectory instead of waiting for the capture to finish
+    calibrator = None
+    seenFiles = set()
+    print(f'Watching {imageDirectory} for new images, press Ctrl+C to stop')
+    try:
+        while not (stopWhenConverged and calibrator is not None and calibrator.converged):
+            newFiles = sorted(set(listImages(imageDirectory)) - seenFiles, key=os.path.getmtime)
+            for fname in newFiles:
+                gray = readGray(fname)
+                if gray is None:
+                    continue  # Most likely still being written, try again on the next poll
+                seenFiles.add(fname)
+
+                corners2 = detectCornersInImage(gray, patternSize, usePyramid, loadCornerSidecar(fname, patternSize))
+                if corners2 is None:
+                    print(f"Chessboard corners not found in {fname}")
+                    continue
+
+                print(f"Accepted {fname}")
+                if calibrator is None:
+                    calibrator = IncrementalCalibrator(patternSize, squareSize, gray.shape[::-1])
+                calibrator.addCorners(corners2)
+
+            if calibrator is not None and calibrator.update():
+                print(calibrator.status())
+            time.sleep(pollInterval)
+    except KeyboardInterrupt:
+        pass
+
+    if calibrator is not None:
+        calibrator.update(force=True)
+        calibrator.close()
+    if calibrator is None or calibrator.cameraMatrix is None:
+        print("Not enough views were collected to calibrate.")
+        return
+
+    print(calibrator.status())
+    saveCalibration(cameraId, calibrator.imageSize, calibrator.cameraMatrix, calibrator.distCoeffs, calibrator.rms, databasePath)
+    print(f'Camera matrix:\n{calibrator.cameraMatrix}')
+    print(f'Distortion coefficients:\n{calibrator.distCoeffs}')
+
+def main(imageDirectory, patternSize, squareSize, numWorkers=None, useCornerCache=True, usePyramid=False, maxViewError=None, maxOutlierIterations=5, maxViews=None,
+         cameraId='camera', databasePath=databaseName, exportPath='cameraCalibration.npz'):
+    patternPoints = makePatternPoints(patternSize, squareSize)
+
+    imageFiles = listImages(imageDirectory)
+    if not imageFiles:
+        print(f"No images found in directory {imageDirectory}")
+        return
+
+    img = readGray(imageFiles[0])
     if img is None:
         print(f'Failed to read {imageFiles[0]} to get resolution!')
         return
 
     h, w = img.shape[:2]
-    print(f'Image resolution {w}x{h}')    
+    print(f'Image resolution {w}x{h}')
+
+    # Only images that are new or have changed since the last run need to go through detection
+    cache = {}
+    cacheKeys = {}
+    pendingFiles = imageFiles
+    if useCornerCache:
+        cachePath = os.path.join(imageDirectory, cornerCacheName)
+        cache = loadCornerCache(cachePath)
+        cacheKeys = {fname: cornerCacheKey(fname, patternSize, usePyramid) for fname in imageFiles}
+        pendingFiles = [fname for fname in imageFiles if cacheKeys[fname] not in cache]
+        print(f'Reusing cached corners for {len(imageFiles) - len(pendingFiles)} out of {len(imageFiles)} images')
+
+    detected = dict(detectAllCorners(pendingFiles, patternSize, numWorkers, usePyramid))
 
     objPoints = []
     imgPoints = []
+    acceptedFiles = []
     numOfAccepted = 0
+    newCache = {}
     for fname in imageFiles:
         print(f"Processing {fname}")
-        img = cv2.imread(fname)
-        gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-        ret, corners = cv2.findChessboardCorners(gray, patternSize, None)
+        if fname in detected:
+            corners2 = detected[fname]
+        else:
+            cached = cache[cacheKeys[fname]]
+            corners2 = cached if len(cached) else None
+
+        if useCornerCache:
+            # Rejected images are cached as empty arrays so they are not retried either
+            newCache[cacheKeys[fname]] = corners2 if corners2 is not None else np.empty((0, 1, 2), np.float32)
 
-        if ret:
-            corners2 = cv2.cornerSubPix(gray, corners, (11, 11), (-1, -1), 
-                                        (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, 30, 0.001))
+        if corners2 is not None:
             imgPoints.append(corners2)
             objPoints.append(patternPoints)
+            acceptedFiles.append(fname)
             numOfAccepted += 1
             print(f"Accepted {fname}")
         else:
             print(f"Chessboard corners not found in {fname}")
 
+    if useCornerCache and (pendingFiles or newCache.keys() != cache.keys()):
+        saveCornerCache(cachePath, newCache)
+
     cv2.destroyAllWindows()
 
     if len(objPoints) == 0 or len(imgPoints) == 0:
         print("No valid chessboard corners were found in the images. Please ensure the chessboard is fully visible and correctly detected.")
         return
 
-    ret, cameraMatrix, distCoeffs, rvecs, tvecs = cv2.calibrateCamera(objPoints, imgPoints, gray.shape[::-1], None, None)
     print(f'Found chessboards in {numOfAccepted} out of {len(imageFiles)} images')
-    np.savez('cameraCalibration.npz', cameraMatrix=cameraMatrix, distCoeffs=distCoeffs, rvecs=rvecs, tvecs=tvecs, rms=ret)
+    if maxViews is not None and numOfAccepted > maxViews:
+        selectedViews = selectDiverseViews(imgPoints, patternSize, (w, h), maxViews)
+        objPoints = [objPoints[i] for i in selectedViews]
+        imgPoints = [imgPoints[i] for i in selectedViews]
+        acceptedFiles = [acceptedFiles[i] for i in selectedViews]
+        print(f'Selected {len(selectedViews)} of the most diverse views for calibration')
+
+    if maxViewError is None:
+        ret, cameraMatrix, distCoeffs, rvecs, tvecs = cv2.calibrateCamera(objPoints, imgPoints, (w, h), None, None)
+    else:
+        ret, cameraMatrix, distCoeffs, rvecs, tvecs, keptViews = calibrateWithOutlierRejection(
+            objPoints, imgPoints, (w, h), acceptedFiles, maxViewError, maxOutlierIterations)
+        objPoints = [objPoints[i] for i in keptViews]
+        imgPoints = [imgPoints[i] for i in keptViews]
+
+    # Compute reprojection error
+    perViewErrors, perCornerResiduals = computeReprojectionErrors(objPoints, imgPoints, rvecs, tvecs, cameraMatrix, distCoeffs)
+    saveCalibration(cameraId, (w, h), cameraMatrix, distCoeffs, ret, databasePath, exportPath, rvecs=rvecs, tvecs=tvecs,
+                    perViewErrors=perViewErrors, perCornerResiduals=perCornerResiduals)
 
     print(f'Camera matrix:\n{cameraMatrix}')
     print(f'Distortion coefficients:\n{distCoeffs}')
 
-    # Compute reprojection error
-    reprodError = {}
-    errors = []
-    for i in range(len(objPoints)):
-        imgPoints2, _ = cv2.projectPoints(objPoints[i], rvecs[i], tvecs[i], cameraMatrix, distCoeffs)
-        error = cv2.norm(imgPoints[i], imgPoints2, cv2.NORM_L2) / len(imgPoints2)
-        errors.append(error)
-
-    reprojectionErrorAvg = np.average(errors)
-    reprojectionErrorStddev = np.std(errors)
+    reprojectionErrorAvg = np.average(perViewErrors)
+    reprojectionErrorStddev = np.std(perViewErrors)
     print(f"Average reprojection error: {reprojectionErrorAvg:.6f} +/- {reprojectionErrorStddev:.6f}")
 
 if __name__ == '__main__':
     imageDirectory = 'calibration_images_20240717-154318'  # Replace with your image directory
     patternSize = (9, 6)  # Number of inner corners per row and column
     squareSize = 0.025  # Square size in meters (25 mm)
+    numWorkers = os.cpu_count()  # Number of processes used for chessboard detection, set to 1 to run serially
+    useCornerCache = True  # Reuse corners detected by previous runs for images that have not changed
+    usePyramid = False  # Search for the chessboard on a downscaled copy first, much faster on 8MP+ images
+    maxViewError = None  # Set to a pixel value (e.g. 1.0) to drop views with a larger reprojection error and recalibrate
+    maxOutlierIterations = 5  # Upper limit on recalibration passes when maxViewError is set
+    maxViews = None  # Set to e.g. 60 to calibrate on only that many of the most varied views, large captures solve much faster
+    runDetectionBenchmark = False  # Set to True to compare full resolution and pyramid detection instead of calibrating
+    runSelectionBenchmark = False  # Set to True to compare all views against a selected subset on synthetic data
+    watchForImages = False  # Set to True to calibrate incrementally while a capture script is still writing into imageDirectory
+    runGateBenchmark = False  # Set to True to compare auto-capture with and without a CaptureGate on a synthetic sequence
+    cameraId = 'webcam'  # Name this camera's calibrations are kept under in the database, one per physical camera
+    databasePath = databaseName  # Every calibration is added here, earlier ones are never overwritten
+    exportPath = 'cameraCalibration.npz'  # The newest calibration is also written here for the trackers, None to skip
 
-    main(imageDirectory, patternSize, squareSize)
+    if watchForImages:
+        watchDirectory(imageDirectory, patternSize, squareSize, usePyramid=usePyramid, cameraId=cameraId, databasePath=databasePath)
+    elif runDetectionBenchmark:
+        benchmarkDetection(imageDirectory, patternSize)
+    elif runGateBenchmark:
+        benchmarkCaptureGate(patternSize)
+    elif runSelectionBenchmark:
+        benchmarkViewSelection(maxViews=maxViews or 30, patternSize=patternSize, squareSize=squareSize)
+    else:
+        main(imageDirectory, patternSize, squareSize, numWorkers, useCornerCache, usePyramid, maxViewError, maxOutlierIterations, maxViews,
+             cameraId, databasePath, exportPath)
@@ -1,15 +1,16 @@
 import cv2
+from frameSource import VideoFrameSource
 
 def main():
-    cap = cv2.VideoCapture(0)
-
-    if not cap.isOpened():
+    try:
+        source = VideoFrameSource(0)
+    except OSError:
         print("Error: Could not open webcam.")
         return
 
     while True:
-        ret, frame = cap.read()
-        if not ret:
+        frame = source.read()
+        if frame is None:
             print("Error: Failed to read frame from webcam.")
             break
 
@@ -21,7 +22,7 @@ def main():
         if cv2.waitKey(1) == 27:
             break
 
-    cap.release()
+    source.close()
     cv2.destroyAllWindows()
 
 if __name__ == "__main__":